@@ -0,0 +1,108 @@
+import os
+import re
+import time
+import random
+import argparse
+
+from cleaner import CleanerClass
+
+# -----------------------------------------------------------------------------
+# Reference implementation: the paragraph by paragraph cleaner, with its pattern tables, as it was before
+# the compiled engine. Kept verbatim to check that the cleaned texts stay byte-identical.
+
+LEGACY_BAD_PATTERNS = [
+    {"pattern": r"\[?\[([0-9][,-–]? ?)+\]\]?,?", "type": "remove"},
+    {"pattern": r"\D[0-9]{1,2},", "type": "remove"},
+    {"pattern": r"([a-zA-Z%])([,\.]*)[0-9]+", "replace": r"\1\2", "type": "replace"},
+    {"pattern": r"i[iv]*\)", "type": "remove"},
+]
+
+LEGACY_PUNCTUATION = [
+    {"pattern": r" +", "replace": " ", "type": "replace"},
+    {"pattern": r"^ ", "type": "remove"},
+    {"pattern": r" $", "type": "remove"},
+    {"pattern": r" \.", "replace": ".", "type": "replace"},
+    {"pattern": r" ,", "replace": ",", "type": "replace"},
+    {"pattern": r" \)", "replace": ")", "type": "replace"},
+    {"pattern": r"\n+", "replace": "\n", "type": "replace"},
+]
+
+
+def legacy_pattern_remover(text, patterns):
+    for pattern in patterns:
+        if pattern["type"] == "replace":
+            if "replace" in pattern.keys() and re.search(pattern["pattern"], text):
+                text = re.sub(pattern["pattern"], pattern["replace"], text)
+        elif pattern["type"] == "remove" and re.search(pattern["pattern"], text):
+            text = re.sub(pattern["pattern"], "", text)
+
+    return text
+
+
+def legacy_clean(text):
+    paragraphs = text.split('\n')
+    clean_paragraphs = []
+
+    for p in paragraphs:
+        clean_p = legacy_pattern_remover(p, LEGACY_BAD_PATTERNS)
+        clean_good_punct_p = legacy_pattern_remover(clean_p, LEGACY_PUNCTUATION)
+        clean_paragraphs.append(clean_good_punct_p)
+
+    return '\n'.join(clean_paragraphs)
+
+# -----------------------------------------------------------------------------
+# Fixture corpus, built from snippets exercising every pattern and their edge cases
+
+
+SNIPPETS = ["Anastomotic leak", "occurred in 12 patients", "[3]", "[4-9]", "[[12]],", "[1, 2, 3]", "[5–7]",
+            "as shown before.2", "in 35%.4 of cases", "Text,3", "3, 4, 7,", "12,", "ii)", "iv)", "i)", "(CRP)",
+            "  ", " ", " .", " ,", " )", ".", ",", "\n", "\n\n", "\n \n", " \n", "\n ", "\t", "٣,", "x٣٤,",
+            "p < 0.05", "CI 1.2-3.4", "et al.", "Smith et al.", "colorectal surgery", "POD 3", "Table 2",
+            "Fig. 1A", "n = 45,", "(n = 3)", "\r\n", "é", "–", "[", "]", "a1,b2,c3"]
+
+
+def fixture_corpus(n_docs=2000, seed=0):
+    random_gen = random.Random(seed)
+    return [" ".join(random_gen.choice(SNIPPETS) for _ in range(random_gen.randint(0, 400)))
+            for _ in range(n_docs)]
+
+
+def folder_corpus(path):
+    corpus = []
+    for folder in sorted(os.listdir(path)):
+        raw_path = os.path.join(path, folder, "raw.txt")
+        if os.path.exists(raw_path):
+            with open(raw_path, "r") as f:
+                corpus.append(f.read())
+    return corpus
+
+# -----------------------------------------------------------------------------
+
+
+parser = argparse.ArgumentParser(description="Compares the compiled cleaner with the paragraph by paragraph one")
+parser.add_argument("--articles", help="Folder of articles with a raw.txt each, the fixture corpus is used if unset")
+parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs, the best one is kept")
+
+args = parser.parse_args()
+corpus = folder_corpus(args.articles) if args.articles else fixture_corpus()
+cleaner = CleanerClass()
+
+legacy_times = []
+engine_times = []
+for _ in range(args.repeat):
+    start = time.perf_counter()
+    legacy_outputs = [legacy_clean(text) for text in corpus]
+    legacy_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    engine_outputs = [cleaner.clean(text) for text in corpus]
+    engine_times.append(time.perf_counter() - start)
+
+mismatches = [i for i, (a, b) in enumerate(zip(legacy_outputs, engine_outputs)) if a.encode() != b.encode()]
+
+print(f"{len(corpus)} documents, {sum(len(text) for text in corpus) / 1e6:.1f}M characters")
+print(f"Paragraph cleaner: {min(legacy_times):.3f}s")
+print(f"Compiled cleaner:  {min(engine_times):.3f}s ({min(legacy_times) / min(engine_times):.1f}x)")
+print(f"Byte-identical outputs: {len(corpus) - len(mismatches)}/{len(corpus)}")
+if len(mismatches) > 0:
+    raise SystemExit(f"Outputs differ for documents {mismatches[:10]}")
@@ -0,0 +1,176 @@
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+# -----------------------------------------------------------------------------
+
+
+def chrome_factory(service, page_load_timeout=60):
+    """
+    Returns a function starting a new headless Chrome driver, to be given to the BrowserPool
+    Pages taking longer than page_load_timeout seconds raise instead of blocking a worker
+    """
+    def factory():
+        options = webdriver.ChromeOptions()
+        options.headless = True
+        driver = webdriver.Chrome(options=options, service=service)
+        driver.set_page_load_timeout(page_load_timeout)
+        return driver
+
+    return factory
+
+
+class _PooledBrowser():
+
+    def __init__(self, driver):
+
+        self.driver = driver
+        self.pages = 0
+
+# -----------------------------------------------------------------------------
+
+
+class BrowserPool():
+
+    def __init__(self, factory, size=4, max_pages=50, ready_timeout=10):
+        """
+        Keeps up to size long-lived drivers, each one is recycled after serving max_pages pages or after a crash
+        factory is any function returning a driver exposing get, page_source, find_element and quit,
+        which allows to test the pool with a local stub instead of Chrome
+        Pages are given up to ready_timeout seconds to show their content, see get_page_source
+        """
+        self.factory = factory
+        self.size = size
+        self.max_pages = max_pages
+        self.ready_timeout = ready_timeout
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+        # Statistics, used to report the latency saved by reusing drivers
+        self.launches = 0
+        self.startup_time = 0
+        self.pages = 0
+        self.page_time = 0
+        self.crashes = 0
+
+    def _launch(self):
+        """
+        Starts a new driver, timing its startup
+        """
+        start = time.perf_counter()
+        driver = self.factory()
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.launches += 1
+            self.startup_time += elapsed
+
+        return _PooledBrowser(driver)
+
+    def _retire(self, browser):
+        try:
+            browser.driver.quit()
+        except Exception:
+            pass
+
+    @contextmanager
+    def browser(self):
+        """
+        Checks out a driver for the duration of the with block
+        Blocks if size drivers are already in use
+        """
+        self._slots.acquire()
+        try:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                browser = self._launch()
+
+            try:
+                yield browser.driver
+            except WebDriverException:
+                # The driver might be in an unknown state, never give it back to the pool
+                with self._lock:
+                    self.crashes += 1
+                self._retire(browser)
+                raise
+            except BaseException:
+                self._retire(browser)
+                raise
+
+            browser.pages += 1
+            if browser.pages >= self.max_pages:
+                self._retire(browser)
+            else:
+                self._idle.put(browser)
+        finally:
+            self._slots.release()
+
+    def _wait_ready(self, driver, ready_selector):
+        """
+        Waits for an element matching the css selector ready_selector, driver.get already waits for the document
+        itself to be loaded. Pages filling their content with javascript, or showing a DDoS protection page first,
+        only get it after that. A page still missing the element after ready_timeout is returned as is
+        """
+        if ready_selector is None:
+            return
+        try:
+            WebDriverWait(driver, self.ready_timeout).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, ready_selector)))
+        except TimeoutException:
+            pass
+
+    def get_page_source(self, url, ready_selector=None):
+        """
+        Loads the url in a pooled driver and returns the html of the page, once an element matching ready_selector
+        shows up if given
+        """
+        with self.browser() as driver:
+            start = time.perf_counter()
+            driver.get(url)
+            self._wait_ready(driver, ready_selector)
+            html = driver.page_source
+            elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.pages += 1
+            self.page_time += elapsed
+
+        return html
+
+    def report(self):
+        """
+        Summary of the pool usage, the latency saved is the startup time that would have been spent
+        launching one driver per page
+        """
+        with self._lock:
+            mean_startup = self.startup_time / self.launches if self.launches else 0
+            mean_page = self.page_time / self.pages if self.pages else 0
+            saved = mean_startup * max(self.pages - self.launches, 0)
+            return {"launches": self.launches,
+                    "pages": self.pages,
+                    "crashes": self.crashes,
+                    "mean_startup": mean_startup,
+                    "mean_page": mean_page,
+                    "saved_per_page": saved / self.pages if self.pages else 0,
+                    "saved_total": saved}
+
+    def close(self):
+        """
+        Quits every idle driver
+        """
+        while True:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._retire(browser)
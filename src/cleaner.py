@@ -0,0 +1,67 @@
+import re
+
+from incremental import config_hash
+
+# -----------------------------------------------------------------------------
+
+# Singular pattern formatting is
+# {"pattern": regex string matching the pattern to act on,
+#  "replace": (optionnal) if type is replace, regex string to use to replace the above matched string,
+#  "type": can be remove or replace, if replace, the replace field needs to be filled in the pattern definition}
+#
+# Patterns are applied one after the other on the whole document at once, with ^ and $ matching at line
+# boundaries. Cleaning is done line by line: a pattern must never match a newline.
+
+# Confusing or useless text patterns to remove or replace
+BAD_PATTERNS = [
+    {"pattern": r"\[?\[([0-9][,-–]? ?)+\]\]?,?", "type": "remove"},  # References mentions [3] or [4-9]
+    {"pattern": r"[^\d\n][0-9]{1,2},", "type": "remove"},  # References mentions 3, 4, 7
+    # References mention Text.2 or 35%.4 or Text,3
+    {"pattern": r"([a-zA-Z%])([,\.]*)[0-9]+", "replace": r"\1\2", "type": "replace"},
+    # {"pattern": r"\(.*?\)", "type": "remove"},  # Anything in parentheses, not greedy matching
+    {"pattern": r"i[iv]*\)", "type": "remove"},  # Roman bullet points in paragraphs
+]
+
+# Same pattern matching, but to run last to cleanup punctuation
+# Once spaces are collapsed, trimming both ends of a line and removing the space before . , and ) do not
+# interact with each other, so they are done in a single pass each
+PUNCTUATION = [
+    {"pattern": r" +", "replace": " ", "type": "replace"},
+    {"pattern": r"^ | $", "type": "remove"},
+    {"pattern": r" ([\.,\)])", "replace": r"\1", "type": "replace"},
+]
+
+# Changes whenever a pattern is added, removed or modified, so the articles cleaned with older rules are redone
+RULES_VERSION = config_hash(BAD_PATTERNS + PUNCTUATION)
+
+# -----------------------------------------------------------------------------
+
+
+def compile_patterns(patterns):
+    """
+    Turns a list of patterns into (compiled regex, replacement string) couples, skipping malformed patterns
+    """
+    rules = []
+    for pattern in patterns:
+        if pattern["type"] == "replace" and "replace" in pattern.keys():
+            rules.append((re.compile(pattern["pattern"], re.MULTILINE), pattern["replace"]))
+        elif pattern["type"] == "remove":
+            rules.append((re.compile(pattern["pattern"], re.MULTILINE), ""))
+
+    return rules
+
+
+class CleanerClass():
+
+    def __init__(self, patterns=BAD_PATTERNS + PUNCTUATION):
+        """
+        Patterns are compiled once, then every document goes through each of them a single time
+        """
+        self.rules = compile_patterns(patterns)
+
+    def clean(self, text):
+
+        for regex, replace in self.rules:
+            text = regex.sub(replace, text)
+
+        return text
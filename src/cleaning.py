@@ -0,0 +1,70 @@
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from tqdm.auto import tqdm
+
+from constants import *
+from cleaner import CleanerClass, RULES_VERSION
+from incremental import text_hash, load_state, save_state
+
+# -----------------------------------------------------------------------------
+
+# Compiled once per worker process
+cleaner = CleanerClass()
+
+
+def clean_article(folder):
+    """
+    Cleans the raw.txt of an article into its clean.txt
+    Skipped if raw.txt and the cleaning rules are the same as the last time, and clean.txt is only rewritten
+    if its content changed, so the following stages only see the articles a new rule actually affected
+    """
+    article_path = os.path.join(ARTICLES_PATH, folder)
+    raw_path = os.path.join(article_path, "raw.txt")
+    clean_path = os.path.join(article_path, "clean.txt")
+    if not os.path.exists(raw_path):
+        return folder, "missing"
+
+    with open(raw_path, "r") as f:
+        text = f.read()
+
+    state = {"raw": text_hash(text), "rules": RULES_VERSION}
+    if load_state(article_path, "clean") == state and os.path.exists(clean_path):
+        return folder, "skipped"
+
+    clean_text = cleaner.clean(text)
+
+    status = "cleaned"
+    if os.path.exists(clean_path):
+        with open(clean_path, "r") as f:
+            if f.read() == clean_text:
+                status = "unchanged"
+    if status == "cleaned":
+        with open(clean_path, "w") as f:
+            f.write(clean_text)
+
+    save_state(article_path, "clean", state)
+    return folder, status
+
+
+def clean_corpus(n_workers=None, chunksize=16):
+    """
+    Cleans every article of ARTICLES_PATH, spread over n_workers processes (all cores by default)
+    """
+    folders = sorted(os.listdir(ARTICLES_PATH))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        statuses = Counter(status for _, status in tqdm(executor.map(clean_article, folders, chunksize=chunksize),
+                                                        total=len(folders)))
+
+    print(f"Cleaned {statuses['cleaned']} articles, {statuses['unchanged']} unchanged by the new rules, "
+          f"{statuses['skipped']} already up to date, {statuses['missing']} without raw.txt")
+
+    return statuses
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    print("Cleaning text...")
+    clean_corpus()
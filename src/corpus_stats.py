@@ -0,0 +1,245 @@
+import os
+import pickle
+import hashlib
+from collections import Counter
+from tqdm.auto import tqdm
+
+import numpy as np
+
+from constants import *
+from entity_store import EntityStore
+
+STATS_PATH = os.path.join(DATA_PATH, "corpus_stats.pkl")
+
+# Statistics of a single document, next to its other files
+SUMMARY_FILENAME = "stats.pkl"
+
+NGRAM_ORDERS = [2, 3]
+
+# The corpus n-gram counts are kept in count-min sketches of SKETCH_DEPTH rows of SKETCH_WIDTH counters, and the
+# MAX_NGRAMS most frequent n-grams are tracked to be listed. Past it, only the most frequent half is kept
+SKETCH_WIDTH = 2 ** 19
+SKETCH_DEPTH = 4
+MAX_NGRAMS = 10000
+
+# Subsets of entities with their own word frequencies, besides all of them
+TOKEN_SUBSETS = {
+    "undef": lambda types, cuis: (types == "ENTITY") & (cuis == "UNDEF"),
+    "proc": lambda types, cuis: types == "PROC",
+    "acti": lambda types, cuis: types == "ACTI",
+}
+
+# -----------------------------------------------------------------------------
+
+
+class NgramSketch():
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, max_candidates=MAX_NGRAMS):
+        """
+        Count-min sketch of n-gram counts, in fixed memory whatever the size of the corpus
+        Counts are only ever overestimated, by the n-grams sharing their counters. Adding counts then removing them
+        gives back the same sketch, in any order, so the totals do not drift when documents are replaced
+        The n-grams with the highest estimates are kept as candidates, to be listed by most_common
+        """
+        self.width = width
+        self.depth = depth
+        self.max_candidates = max_candidates
+        self.table = np.zeros((depth, width), dtype=np.int32)
+        # Candidate n-grams, along with their counter in every row
+        self.candidates = {}
+
+    def _columns(self, keys):
+        """
+        Counter of each key in every row of the table, hashed with blake2b so they are the same from one run to the next
+        """
+        columns = np.zeros((len(keys), self.depth), dtype=np.uint64)
+        for i, key in enumerate(keys):
+            digest = hashlib.blake2b("\x1f".join(key).encode("utf-8"), digest_size=8 * self.depth).digest()
+            columns[i] = np.frombuffer(digest, dtype=np.uint64)
+        return (columns % np.uint64(self.width)).astype(np.int64)
+
+    def _add(self, counts, sign):
+        """
+        Adds the counts times sign, returns the n-grams along with their counters
+        """
+        keys = list(counts.keys())
+        columns = self._columns(keys)
+        values = sign * np.array([counts[key] for key in keys], dtype=np.int32)
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[:, row], values)
+        return keys, columns
+
+    def _estimates(self, columns):
+        return self.table[np.arange(self.depth), columns].min(axis=1)
+
+    def update(self, counts):
+        """
+        Adds the counts of a Counter of n-grams
+        """
+        keys, columns = self._add(counts, 1)
+        self.candidates.update(zip(keys, columns))
+        if len(self.candidates) > self.max_candidates:
+            kept = self.most_common(self.max_candidates // 2)
+            self.candidates = {key: self.candidates[key] for key, _ in kept}
+
+    def __isub__(self, counts):
+        """
+        Removes the counts of a Counter of n-grams, n-grams whose estimate falls to zero are not listed anymore
+        """
+        self._add(counts, -1)
+        return self
+
+    def most_common(self, n=None):
+        """
+        Candidate n-grams and their estimated counts, the most frequent first, like Counter.most_common
+        """
+        keys = list(self.candidates.keys())
+        estimates = self._estimates(np.array(list(self.candidates.values()), dtype=np.int64).reshape(-1, self.depth))
+        order = np.argsort(-estimates, kind="stable")
+        ranked = [(keys[i], int(estimates[i])) for i in order if estimates[i] > 0]
+        return ranked if n is None else ranked[:n]
+
+
+class CorpusStats():
+
+    def __init__(self, exact=False):
+        """
+        Frequencies over the entities of a set of documents: entity types, words (all of them, and each subset of
+        TOKEN_SUBSETS) and n-grams of consecutive words of a document
+        Statistics are merged and subtracted counter by counter, so the totals of the corpus are the merge of the
+        summaries of its documents, in any order, and subtracting a summary exactly undoes its merge. contributions
+        keeps the hash of the entities each document was counted from, to know which summaries are outdated
+        exact keeps every n-gram count, for the summaries of single documents. Otherwise n-grams are counted in
+        sketches, so the corpus totals stay the same size as the corpus grows
+        """
+        self.documents = 0
+        self.types = Counter()
+        self.tokens = {"all": Counter(), **{name: Counter() for name in TOKEN_SUBSETS}}
+        self.ngrams = {n: Counter() if exact else NgramSketch() for n in NGRAM_ORDERS}
+        self.contributions = {}
+
+    def _counters(self):
+        return [self.types] + list(self.tokens.values()) + list(self.ngrams.values())
+
+    def add_document(self, entities_df):
+        types = entities_df["Type"].astype(str)
+        cuis = entities_df["CUI"].astype(str)
+        words = entities_df["Word"].astype(str)
+
+        self.documents += 1
+        self.types.update(types.value_counts().to_dict())
+        self.tokens["all"].update(words.values)
+        for name, subset in TOKEN_SUBSETS.items():
+            self.tokens[name].update(words[subset(types, cuis)].values)
+
+        words = list(words.values)
+        for n in NGRAM_ORDERS:
+            self.ngrams[n].update(Counter(zip(*[words[i:] for i in range(n)])))
+
+    def merge(self, other):
+        """
+        Adds the counts of other, a summary with exact n-gram counts
+        """
+        self.documents += other.documents
+        for counter, other_counter in zip(self._counters(), other._counters()):
+            counter.update(other_counter)
+
+    def subtract(self, other):
+        """
+        Removes the counts of other, counts falling to zero are dropped
+        """
+        self.documents -= other.documents
+        for counter, other_counter in zip(self._counters(), other._counters()):
+            counter -= other_counter
+
+    def save(self, path=STATS_PATH):
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self, f)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path=STATS_PATH):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+# -----------------------------------------------------------------------------
+
+
+def _summary_path(document):
+    return os.path.join(ARTICLES_PATH, document, SUMMARY_FILENAME)
+
+
+def load_summary(document, entities_hash):
+    """
+    Statistics of a document, None if they were never computed or were computed from other entities
+    """
+    try:
+        with open(_summary_path(document), "rb") as f:
+            saved = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if saved["entities"] != entities_hash:
+        return None
+    return saved["stats"]
+
+
+def save_summary(document, entities_hash, summary):
+    path = _summary_path(document)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump({"entities": entities_hash, "stats": summary}, f)
+    os.replace(path + ".tmp", path)
+
+
+def document_summary(store, document, entities_hash, recompute=False):
+    """
+    Statistics of a document, from its saved summary if it is up to date, computed and saved otherwise
+    """
+    summary = None if recompute else load_summary(document, entities_hash)
+    if summary is None:
+        summary = CorpusStats(exact=True)
+        summary.add_document(store.read_document(document, columns=["Word", "Type", "CUI"]))
+        save_summary(document, entities_hash, summary)
+    return summary
+
+
+def refresh_corpus_stats(stats, path=STATS_PATH, recompute=False):
+    """
+    Brings the totals up to date with the entity store: the summaries of new documents are merged, the ones of
+    changed documents are replaced, and the ones of removed documents are subtracted
+    Starts over from empty totals if an outdated summary is gone, since its counts cannot be taken back
+    recompute ignores the saved summaries of the documents
+    """
+    store = EntityStore()
+    store.update()
+
+    outdated = [document for document, entry in store.documents.items()
+                if stats.contributions.get(document) != entry[3]]
+    removed = [document for document in stats.contributions if document not in store]
+
+    for document in outdated + removed:
+        if document in stats.contributions:
+            previous = load_summary(document, stats.contributions[document])
+            if previous is None:
+                return refresh_corpus_stats(CorpusStats(), path, recompute)
+            stats.subtract(previous)
+            del stats.contributions[document]
+
+    for document in tqdm(outdated):
+        entities_hash = store.documents[document][3]
+        stats.merge(document_summary(store, document, entities_hash, recompute))
+        stats.contributions[document] = entities_hash
+
+    stats.save(path)
+    print(f"Corpus statistics: {len(outdated)} documents added or updated, {len(removed)} removed, "
+          f"{stats.documents} documents in total")
+    return stats
+
+
+def get_corpus_stats(rescan=False, path=STATS_PATH):
+    """
+    Statistics of the corpus, the cached totals updated with the documents that changed since they were saved
+    rescan computes everything again, from the entities of every document
+    """
+    if rescan or not os.path.exists(path):
+        return refresh_corpus_stats(CorpusStats(), path, recompute=rescan)
+    return refresh_corpus_stats(CorpusStats.load(path), path)
@@ -1,13 +1,11 @@
 import os
 import argparse
 
-import spacy
-import numpy as np
-import pandas as pd
-
 from termcolor import colored
 
 from constants import *
+from storage import read_entities
+from entity_store import EntityStore
 
 
 def get_color_map_types(entities_df):
@@ -73,7 +71,11 @@ filename = args.filename
 with open(os.path.join(ARTICLES_PATH, filename, "clean.txt"), "r") as f:
     text = f.read()
 
-with open(os.path.join(ARTICLES_PATH, filename, "entities.csv"), "r") as f:
-    entities_df = pd.read_csv(f)
+# The store is kept up to date by ner.py, articles not consolidated yet are read from their own folder
+store = EntityStore()
+if filename in store:
+    entities_df = store.read_document(filename, columns=["Type", "StartChar", "EndChar"])
+else:
+    entities_df = read_entities(filename, columns=["Type", "StartChar", "EndChar"])
 
 print_entity_types(text, entities_df)
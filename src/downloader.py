@@ -3,109 +3,79 @@ import time
 import re
 from tqdm.auto import tqdm
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pickle
-import requests
 from bs4 import BeautifulSoup
-from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 
 from constants import *
+from cleaning import clean_corpus
+from network import HostRateLimiter, HTTPClient
+from browser_pool import BrowserPool, chrome_factory
+from manifest import DownloadManifest
+from http_cache import HTTPCache
+from eutils import EUtilsClient
+from incremental import text_hash
 
 search_terms = ["anastomotic", "leak"]
 
-# -----------------------------------------------------------------------------
-
-# Singular pattern formatting is
-# {"pattern": regex string matching the pattern to act on,
-#  "replace": (optionnal) if type is replace, regex string to use to replace the above matched string,
-#  "type": can be remove or replace, if replace, the replace field needs to be filled in the pattern definition}
-
-# Confusing or useless text patterns to remove or replace
-BAD_PATTERNS = [
-    {"pattern": r"\[?\[([0-9][,-–]? ?)+\]\]?,?", "type": "remove"},  # References mentions [3] or [4-9]
-    {"pattern": r"\D[0-9]{1,2},", "type": "remove"},  # References mentions 3, 4, 7
-    # References mention Text.2 or 35%.4 or Text,3
-    {"pattern": r"([a-zA-Z%])([,\.]*)[0-9]+", "replace": r"\1\2", "type": "replace"},
-    # {"pattern": r"\(.*?\)", "type": "remove"},  # Anything in parentheses, not greedy matching
-    {"pattern": r"i[iv]*\)", "type": "remove"},  # Roman bullet points in paragraphs
-]
-
-# Same pattern matching, but to run last to cleanup punctuation
-PUNCTUATION = [
-    {"pattern": r" +", "replace": " ", "type": "replace"},
-    {"pattern": r"^ ", "type": "remove"},
-    {"pattern": r" $", "type": "remove"},
-    {"pattern": r" \.", "replace": ".", "type": "replace"},
-    {"pattern": r" ,", "replace": ",", "type": "replace"},
-    {"pattern": r" \)", "replace": ")", "type": "replace"},
-    {"pattern": r"\n+", "replace": "\n", "type": "replace"},
-]
-
-# -----------------------------------------------------------------------------
-
-
-class CleanerClass():
-
-    def __init__(self):
-        pass
-
-    def _pattern_remover(self, text, patterns):
-        """
-        Given text, removes or replaces a list of patterns from it.
-        """
-        for pattern in patterns:
-            if pattern["type"] == "replace":
-                if "replace" in pattern.keys() and re.search(pattern["pattern"], text):
-                    text = re.sub(pattern["pattern"], pattern["replace"], text)
-            elif pattern["type"] == "remove" and re.search(pattern["pattern"], text):
-                text = re.sub(pattern["pattern"], "", text)
-
-        return text
-
-    def clean(self, text):
-
-        paragraphs = text.split('\n')
-        clean_paragraphs = []
+# Number of articles fetched at the same time, each host is still rate limited by HostRateLimiter
+n_workers = 8
 
-        for p in paragraphs:
-            clean_p = self._pattern_remover(p, BAD_PATTERNS)
-            clean_good_punct_p = self._pattern_remover(clean_p, PUNCTUATION)
-            clean_paragraphs.append(clean_good_punct_p)
+# Where the search results and the articles metadata come from
+# "scraper" parses the PubMed pages one article at a time, "eutils" uses batched E-utilities requests
+metadata_backend = "eutils"
 
-        return '\n'.join(clean_paragraphs)
+# Element holding the content of the page of each source, full texts are read once it shows up
+READY_SELECTORS = {"Wiley": "section.article-section__full",
+                   "Springer": "div.c-article-body",
+                   "Elsevier Science": "div#body"}
 
 # -----------------------------------------------------------------------------
 
 
 class DownloaderClass():
 
-    def __init__(self):
+    def __init__(self, rate_limiter=None, http=None, browser_pool=None, manifest=None, cache=None, n_browsers=4,
+                 metadata_backend="scraper", eutils=None):
 
         self.ser = Service(ChromeDriverManager().install())
+        if rate_limiter is None:
+            rate_limiter = HostRateLimiter()
+        self.rate_limiter = rate_limiter
+        if http is None:
+            http = HTTPClient(rate_limiter=rate_limiter, pool_size=max(n_browsers, 10))
+        self.http = http
+        if browser_pool is None:
+            browser_pool = BrowserPool(chrome_factory(self.ser), size=n_browsers)
+        self.browser_pool = browser_pool
+        if manifest is None:
+            manifest = DownloadManifest()
+        self.manifest = manifest
+        if cache is None:
+            cache = HTTPCache()
+        self.cache = cache
+
+        if metadata_backend not in ["scraper", "eutils"]:
+            raise NotImplementedError(f"Metadata backend {metadata_backend} is unknown.")
+        self.metadata_backend = metadata_backend
+        if metadata_backend == "eutils" and eutils is None:
+            eutils = EUtilsClient()
+        self.eutils = eutils
+        # Metadata of the articles gathered in batches when using E-utilities, filled by download
+        self.metadata = {}
 
     def _pget(self, url, stream=False):
         """
-        Acounts for network errors in   getting a request (Pubmed often appears offline, but not for long periods of time)
-        Retries every 2 seconds for 60 seconds and then gives up
+        Gets a page through the shared HTTP cache, streamed requests always go to the network
+        Network errors are retried with backoff by the HTTP client, failing hosts are cut off by its circuit breaker
+        (PubMed and E-utilities are waited for instead, since every article needs them)
         """
-        downloaded = False
-        count = 0
-
-        while not downloaded and count < 60:
-            try:
-                page = requests.get(url, stream=stream)
-                downloaded = True
-            except:
-                print(url + f" - Network error, retrying... ({count + 1})")
-                time.sleep(2)
-                count += 1
-
-        if page != None:
-            return page
-        else:
-            raise ValueError
+        if stream:
+            return self.http.get(url, stream=True)
+        return self.cache.get(url, self.http.get)
 
     def _get_search_matches(self, search_terms, max_page_num=False):
         """
@@ -113,6 +83,11 @@ class DownloaderClass():
         Optionnaly, set a max number of pages to search through (10 articles per page)
         Selenium not used here
         """
+        if self.metadata_backend == "eutils":
+            max_results = max_page_num * 10 if max_page_num else None
+            self.search_results_ids = self.eutils.search(search_terms, max_results=max_results)
+            return
+
         # Filtering out every non English match
         search_url = "https://pubmed.ncbi.nlm.nih.gov/?term=" + '+'.join(search_terms) + '&filter=lang.english'
         full_search_ids = []
@@ -137,13 +112,10 @@ class DownloaderClass():
         # Saving the results
         self.search_results_ids = full_search_ids
 
-    def _get_article_features(self, article_id):
+    def _scrape_article_metadata(self, article_id):
         """
-        Finds the url of the corresponding article based on the article id in the page, wherever it might be hosted
+        Gets the metadata of an article and the link to its full text from its PubMed page
         """
-        # Tracks whether or not the url was found
-        found = True
-
         # Getting the inital page
         pubmed_url = "https://pubmed.ncbi.nlm.nih.gov/" + article_id + "/"
         pubmed_page = self._pget(pubmed_url)
@@ -185,34 +157,71 @@ class DownloaderClass():
             dl_features = pubmed_soup.find("div", {"class": "full-text-links"}).find("a", {"class": "link-item"})
             dl_url = dl_features.get('href')
             dl_page_type = dl_features.get('data-ga-action')
+        except AttributeError:
+            dl_url, dl_page_type = None, None
+
+        return {"ID": article_id,
+                "Title": title,
+                "Authors": author_names,
+                "Date": date,
+                "Citations": citations_ids,
+                "FullTextURL": dl_url,
+                "Source": dl_page_type,
+                "HTTPStatus": pubmed_page.status_code}
+
+    def _get_article_features(self, article_id, fetch_text=True):
+        """
+        Finds the url of the corresponding article based on the article id in the page, wherever it might be hosted
+        With fetch_text set to False, only the PubMed metadata is gathered and the full text is not downloaded
+        Also returns the source type of the full text and the HTTP status of the PubMed page, for the manifest
+        The metadata comes from the batches gathered by download when using E-utilities, from the PubMed page otherwise
+        """
+        if article_id in self.metadata:
+            metadata = self.metadata[article_id]
+        else:
+            metadata = self._scrape_article_metadata(article_id)
+        title, author_names, date, citations_ids = (metadata["Title"], metadata["Authors"],
+                                                    metadata["Date"], metadata["Citations"])
+        dl_url, dl_page_type = metadata["FullTextURL"], metadata["Source"]
+        http_status = metadata.get("HTTPStatus")
 
-            dl_soup = self._get_soup(dl_url)
+        if not fetch_text:
+            return True, title, author_names, date, citations_ids, None, None, http_status
+
+        if dl_url is None:
+            return False, title, author_names, date, citations_ids, "", dl_page_type, http_status
+
+        # Grabbing the full text if available
+        try:
+            dl_html, from_cache = self._get_page_source(dl_url, READY_SELECTORS.get(dl_page_type))
+            dl_soup = BeautifulSoup(dl_html, 'lxml')  # .encode("utf-8")
             response, text = self._get_text(dl_soup, dl_page_type)
+            if response and not from_cache:
+                # Only pages the text could be extracted from are cached, DDoS protection pages are not
+                self.cache.store(dl_url, dl_html.encode("utf-8"), encoding="utf-8")
             if not response:
                 text = ""
         except:
             response = False
             text = ""
 
-        return response, title, author_names, date, citations_ids, text
+        return response, title, author_names, date, citations_ids, text, dl_page_type, http_status
 
-    def _get_soup(self, url):
+    def _get_page_source(self, url, ready_selector=None):
         """
-        Requests the soup from a page
-        Selenium is used to account for DDoS protection that exists for some websites
+        Requests the html of a page, and whether it was served by the cache
+        Selenium is used to account for DDoS protection that exists for some websites, the page is read once an
+        element matching ready_selector (the content _get_text looks for) shows up
+        Drivers are borrowed from the browser pool instead of starting a new Chrome for every page
         """
-        options = webdriver.ChromeOptions()
-        options.headless = True
-        browser = webdriver.Chrome(options=options, service=self.ser)
-
-        browser.get(url)
-        time.sleep(2)
-        html = browser.page_source
-        soup = BeautifulSoup(html, 'lxml')  # .encode("utf-8")
+        cached, fresh = self.cache.lookup(url)
+        if cached is not None and fresh:
+            return cached.text, True
 
-        browser.close()
+        self.rate_limiter.wait(url)
+        html = self.http.breaker.call(url, self.browser_pool.get_page_source, url, ready_selector)
 
-        return soup
+        return html, False
 
     def _get_text(self, soup, source_name):
         """
@@ -272,9 +281,44 @@ class DownloaderClass():
         else:
             return False, f"{source_name}: Not implemented"
 
-    def download(self, search_terms, max_page_num=False, overwrite=False):
+    def _save_citations(self):
+        """
+        Rebuilds citations.csv and citations.pkl from the manifest, no article is fetched again
+        """
+        citations_df = self.manifest.citations_df(self.search_results_ids)
+
+        with open(os.path.join(DATA_PATH, "citations.csv"), "w") as f:
+            citations_df.to_csv(f, sep="|")
+
+        with open(os.path.join(DATA_PATH, "citations.pkl"), "wb") as f:
+            pickle.dump(citations_df, f)
+
+    def _gather_metadata(self, ids):
+        """
+        Gets the metadata of the articles from E-utilities, one batch of ids at a time
+        The ids of a batch that fails are recorded as errors in the manifest, so the next run retries them,
+        and returned so they are left out of this run
+        """
+        self.metadata = {}
+        failed = set()
+        batch_size = self.eutils.batch_size
+        for i in tqdm(range(0, len(ids), batch_size)):
+            batch = ids[i:i + batch_size]
+            try:
+                self.metadata.update(self.eutils.get_articles(batch))
+            except Exception as e:
+                print(f"Metadata of {len(batch)} articles could not be gathered: {e!r}")
+                for article_id in batch:
+                    self.manifest.record(article_id, "error", message=repr(e))
+                failed.update(batch)
+        return failed
+
+    def download(self, search_terms, max_page_num=False, overwrite=False, n_workers=1, save_every=100):
         """
         Downloads the pdfs of matching search results
+        Up to n_workers articles are fetched concurrently, politeness is handled per host by the rate limiter
+        Every article is committed to the manifest as soon as it is done, and articles already downloaded in
+        a previous run are skipped. The citations files are rebuilt from the manifest every save_every articles
         """
         save_search_id_name = "full_search_ids_" + "_".join(search_terms) + ".pkl"
 
@@ -289,57 +333,91 @@ class DownloaderClass():
                 self.search_results_ids = pickle.load(f)
         print(f"Found {len(self.search_results_ids)} matching documents.")
 
+        to_download, metadata_only = self.manifest.pending(self.search_results_ids)
+        print(f"{len(self.search_results_ids) - len(to_download) - len(metadata_only)} already downloaded, "
+              f"{len(metadata_only)} missing their metadata, {len(to_download)} to download.")
+
+        if self.metadata_backend == "eutils":
+            print("Gathering metadata...")
+            failed = self._gather_metadata(to_download + metadata_only)
+            to_download = [article_id for article_id in to_download if article_id not in failed]
+            metadata_only = [article_id for article_id in metadata_only if article_id not in failed]
+
         print("Downloading...")
         doc_num = 0
         found_num = 0
-        articles_list = []
-        log = "Logged actions -------------------\n"
-
-        for article_id in tqdm(self.search_results_ids):
-            doc_num += 1
-            response, title, authors, date, citations_ids, text = self._get_article_features(article_id)
-
-            if response:
-                found_num += 1
-                articles_list.append({"ID": article_id,
-                                      "Title": title,
-                                      "Authors": authors,
-                                      "Date": date,
-                                      "Citations": citations_ids})
-                article_path = os.path.join(ARTICLES_PATH, article_id)
-                if not os.path.exists(article_path):
-                    os.mkdir(article_path)
-                with open(os.path.join(article_path, "raw.txt"), "w") as f:
-                    f.write(text)
-                log += article_id + " - Downloaded\n"
-            else:
-                log += text + "\n"
+        with open(os.path.join(LOGS_PATH, "download_log.txt"), "w") as log_file:
+            log_file.write("Logged actions -------------------\n")
+
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(self._get_article_features, article_id): article_id
+                           for article_id in to_download}
+                futures.update({executor.submit(self._get_article_features, article_id, fetch_text=False): article_id
+                                for article_id in metadata_only})
+
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    article_id = futures[future]
+                    doc_num += 1
+                    try:
+                        response, title, authors, date, citations_ids, text, source, http_status = future.result()
+                    except Exception as e:
+                        self.manifest.record(article_id, "error", message=repr(e))
+                        log_file.write(f"{article_id} - Failed: {e!r}\n")
+                        log_file.flush()
+                        continue
+
+                    if response:
+                        found_num += 1
+                        article_path = os.path.join(ARTICLES_PATH, article_id)
+                        if text is None:
+                            # Metadata only, the text was downloaded by a previous run
+                            with open(os.path.join(article_path, "raw.txt"), "r") as f:
+                                text = f.read()
+                        else:
+                            if not os.path.exists(article_path):
+                                os.mkdir(article_path)
+                            with open(os.path.join(article_path, "raw.txt"), "w") as f:
+                                f.write(text)
+                        self.manifest.record(article_id, "downloaded", http_status=http_status, source=source,
+                                             content_hash=text_hash(text), title=title, authors=authors,
+                                             date=date, citations=citations_ids)
+                        log_file.write(article_id + " - Downloaded\n")
+                    else:
+                        self.manifest.record(article_id, "failed", http_status=http_status, source=source,
+                                             title=title, authors=authors, date=date, citations=citations_ids)
+                        log_file.write(text + "\n")
+                    log_file.flush()
+
+                    if doc_num % save_every == 0:
+                        self._save_citations()
 
         time.sleep(1)
 
-        log = f"Downloaded {found_num}/{len(self.search_results_ids)} documents\n" + log
-        with open(os.path.join(LOGS_PATH, "download_log.txt"), "w") as f:
-            f.write(log)
+        pool_report = self.browser_pool.report()
+        pool_log = (f"Browser pool: {pool_report['pages']} pages served by {pool_report['launches']} drivers "
+                    f"({pool_report['crashes']} crashes), mean startup {pool_report['mean_startup']:.2f}s, "
+                    f"saved {pool_report['saved_per_page']:.2f}s per page ({pool_report['saved_total']:.0f}s total)\n")
+        cache_log = (f"HTTP cache: {self.cache.hits} hits, {self.cache.revalidated} revalidated, "
+                     f"{self.cache.misses} misses\n")
+        open_hosts = self.http.breaker.open_hosts()
+        if len(open_hosts) > 0:
+            cache_log += "Hosts cut off after repeated failures: " + ", ".join(open_hosts) + "\n"
+        pool_log += cache_log
+        print(pool_log, end="")
 
-        with open(os.path.join(DATA_PATH, "citations.csv"), "w") as f:
-            citations_df = pd.DataFrame(articles_list).set_index("ID")
-            citations_df.to_csv(f, sep="|")
+        with open(os.path.join(LOGS_PATH, "download_log.txt"), "a") as log_file:
+            log_file.write(f"Downloaded {found_num}/{len(futures)} documents in this run\n" + pool_log)
 
-        with open(os.path.join(DATA_PATH, "citations.pkl"), "wb") as f:
-            pickle.dump(citations_df, f)
+        self._save_citations()
 
 # -----------------------------------------------------------------------------
 
 
-downloader = DownloaderClass()
-print("Downloading...")
-downloader.download(search_terms, max_page_num=None, overwrite=True)
+if __name__ == "__main__":
+    downloader = DownloaderClass(n_browsers=n_workers, metadata_backend=metadata_backend)
+    print("Downloading...")
+    downloader.download(search_terms, max_page_num=None, overwrite=True, n_workers=n_workers)
+    downloader.browser_pool.close()
 
-cleaner = CleanerClass()
-print("Cleaning text...")
-for folder_path in tqdm(os.listdir(ARTICLES_PATH)):
-    with open(os.path.join(ARTICLES_PATH, folder_path, "raw.txt"), "r") as f:
-        text = f.read()
-    clean_text = cleaner.clean(text)
-    with open(os.path.join(ARTICLES_PATH, folder_path, 'clean.txt'), "w") as f:
-        f.write(clean_text)
+    print("Cleaning text...")
+    clean_corpus()
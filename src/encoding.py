@@ -1,4 +1,7 @@
 import os
+import argparse
+
+import numpy as np
 import pandas as pd
 
 import torch
@@ -7,15 +10,32 @@ from transformers import AutoTokenizer, AutoModel
 from tqdm.auto import tqdm
 
 from constants import *
+from entity_store import EntityStore
+
+MODEL_NAME = "bert-base-uncased"
+ENCODINGS_PATH = os.path.join(DATA_PATH, "encodings.npz")
+
+# Sentences are encoded BATCH_SIZE at a time, cut after MAX_LENGTH tokens, over N_THREADS CPU threads
+BATCH_SIZE = 64
+MAX_LENGTH = 100
+N_THREADS = 4
+
+# -----------------------------------------------------------------------------
 
-sentences_list = []
 
-for filename in os.listdir(ARTICLES_PATH):
+def get_document_sentences():
+    """
+    Sentences of every document, each sentence being the words of its entities
+    """
+    store = EntityStore()
+    store.update()
 
-    with open(os.path.join(ARTICLES_PATH, filename, "entities.csv"), "r") as f:
-        entities_df = pd.read_csv(f).drop("Unnamed: 0", axis=1).dropna()
+    sentences_list = []
+    for filename, entities_df in store.iter_documents(columns=["Word", "Sentence"]):
+        entities_df = entities_df.dropna()
         doc_sentences_raw = entities_df.groupby("Sentence")["Word"].agg(lambda x: " ".join(x))
-        doc_sentences = [''.join([c for c in s if c.isalpha() or c == " " or c == "-"]).strip() for s in doc_sentences_raw]
+        doc_sentences = [''.join([c for c in s if c.isalpha() or c == " " or c == "-"]).strip()
+                         for s in doc_sentences_raw]
         doc_sentences = [s for s in doc_sentences if len(s) > 0]
 
         sentences_dict = {}
@@ -24,21 +44,74 @@ for filename in os.listdir(ARTICLES_PATH):
 
         sentences_list.append(sentences_dict)
 
-sentences_df = pd.DataFrame(sentences_list)
-sentences_df["Len"] = sentences_df["Sentences"].apply(lambda x: len(x))
+    sentences_df = pd.DataFrame(sentences_list, columns=["Document", "Sentences"])
+    sentences_df["Len"] = sentences_df["Sentences"].apply(lambda x: len(x))
+    return sentences_df
+
+
+def encode_sentences(sentences, tokenizer, model, batch_size=BATCH_SIZE, max_length=MAX_LENGTH):
+    """
+    Mean of the last hidden states over the tokens of every sentence, as a float32 (sentences, hidden size) array
+    Sentences are tokenized once, then sorted by length so each batch is only padded to its longest sentence
+    """
+    vectors = np.zeros((len(sentences), model.config.hidden_size), dtype=np.float32)
+    if len(sentences) == 0:
+        return vectors
+
+    encodings = tokenizer(sentences, truncation=True, max_length=max_length)
+    order = np.argsort([len(ids) for ids in encodings["input_ids"]], kind="stable")
+
+    with torch.inference_mode():
+        for start in tqdm(range(0, len(sentences), batch_size)):
+            batch_ids = order[start:start + batch_size]
+            features = [{key: encodings[key][i] for key in encodings.keys()} for i in batch_ids]
+            inputs = tokenizer.pad(features, return_tensors="pt")
+
+            hidden_states = model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            vectors[batch_ids] = pooled.numpy()
+
+    return vectors
+
+
+def encode_corpus(batch_size=BATCH_SIZE, max_length=MAX_LENGTH, n_threads=N_THREADS, path=ENCODINGS_PATH):
+    """
+    Encodes the sentences of every document, and saves their vectors with the documents they belong to:
+    the sentences of documents[i] are vectors[offsets[i]:offsets[i + 1]]
+    """
+    torch.set_num_threads(n_threads)
+
+    sentences_df = get_document_sentences()
+    sentences = [s for doc_sentences in sentences_df["Sentences"] for s in doc_sentences]
+    offsets = np.concatenate([[0], np.cumsum(sentences_df["Len"].values)]).astype(np.int64)
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModel.from_pretrained(MODEL_NAME)
+    model.eval()
+
+    vectors = encode_sentences(sentences, tokenizer, model, batch_size, max_length)
+    np.savez(path, vectors=vectors, offsets=offsets, documents=sentences_df["Document"].values.astype(str))
+
+    return vectors, offsets
 
-tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-model = AutoModel.from_pretrained("bert-base-uncased")
 
-sentences_encodings = []
+def load_encodings(path=ENCODINGS_PATH):
+    """
+    Returns the sentence vectors, the offsets of each document and the document names
+    """
+    with np.load(path) as encodings:
+        return encodings["vectors"], encodings["offsets"], encodings["documents"]
 
-for i in tqdm(range(len(sentences_df))):
+# -----------------------------------------------------------------------------
 
-    inputs = tokenizer(sentences_df.iloc[i]["Sentences"], return_tensors="pt", padding="max_length", max_length=100)
-    outputs = model(**inputs)
-    encoding = outputs.last_hidden_state
 
-    sentences_encodings.append(encoding)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encodes the sentences of every document with BERT")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE, help="Number of sentences encoded at a time")
+    parser.add_argument("--max_length", type=int, default=MAX_LENGTH, help="Maximum number of tokens per sentence")
+    parser.add_argument("--threads", type=int, default=N_THREADS, help="Number of CPU threads used by torch")
+    args = parser.parse_args()
 
-with open(os.path.join(DATA_PATH, 'encodings.pkl'), "rb") as f:
-    pickle.dump(sentences_encodings, f)
+    vectors, offsets = encode_corpus(args.batch_size, args.max_length, args.threads)
+    print(f"Saved {len(vectors)} sentence vectors of {len(offsets) - 1} documents to {ENCODINGS_PATH}")
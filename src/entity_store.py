@@ -0,0 +1,230 @@
+import os
+import json
+import argparse
+from tqdm.auto import tqdm
+
+import pyarrow as pa
+
+from constants import *
+from incremental import file_hash, file_signature
+from storage import ENTITIES_SCHEMA, stored_path, read_entities, to_arrow
+
+STORE_PATH = os.path.join(DATA_PATH, "entity_store")
+
+# New or changed documents are appended APPEND_DOCUMENTS at a time, each batch becoming a new segment
+APPEND_DOCUMENTS = 2000
+# Rows per record batch inside a segment
+BATCH_ROWS = 65536
+# Segments are rewritten once less than this share of their rows still belongs to a live document
+COMPACT_RATIO = 0.5
+
+# -----------------------------------------------------------------------------
+
+
+class EntityStore():
+
+    def __init__(self, path=STORE_PATH):
+        """
+        Append-only store of the entities of the whole corpus
+        Entities live in a few large Arrow files (segments), read through memory maps. The index maps every document
+        to its segment, first row and number of rows, along with the hash and the signature (modification time and
+        size) of the table it was copied from
+        A document that changes is appended again and its old rows become garbage, removed by compact
+        """
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        os.makedirs(path, exist_ok=True)
+
+        self.index = {"next_segment": 0, "segments": {}, "documents": {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        self.documents = self.index["documents"]
+
+        self._segments = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"segment_{int(segment):05d}.arrow")
+
+    def _save_index(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _segment(self, segment):
+        """
+        Whole table of a segment, memory-mapped: nothing is read until the rows are used
+        """
+        segment = str(segment)
+        if segment not in self._segments:
+            source = pa.memory_map(self._segment_path(segment), "r")
+            self._segments[segment] = pa.ipc.open_file(source).read_all()
+        return self._segments[segment]
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, document):
+        return document in self.documents
+
+    # -------------------------------------------------------------------------
+
+    def append(self, tables):
+        """
+        Writes a new segment holding the given documents, tables maps each document to its arrow table, hash and
+        signature
+        The index is only saved once the segment is complete, so an interrupted append leaves the store unchanged
+        """
+        if len(tables) == 0:
+            return
+
+        segment = str(self.index["next_segment"])
+        table = pa.concat_tables([table for table, _, _ in tables.values()]).unify_dictionaries().combine_chunks()
+        with pa.OSFile(self._segment_path(segment), "wb") as sink:
+            with pa.ipc.new_file(sink, ENTITIES_SCHEMA) as writer:
+                writer.write_table(table, max_chunksize=BATCH_ROWS)
+
+        offset = 0
+        for document, (document_table, table_hash, signature) in tables.items():
+            self.documents[document] = [segment, offset, document_table.num_rows, table_hash, signature]
+            offset += document_table.num_rows
+        self.index["segments"][segment] = table.num_rows
+        self.index["next_segment"] += 1
+        self._save_index()
+
+    def update(self, folders=None):
+        """
+        Brings the store up to date with the entities tables of the articles: new and changed documents are
+        appended, documents without entities anymore are dropped
+        Only the given folders are looked at, the other documents of the store are left as they are
+        Tables are only read when their signature changed, and only appended again if their hash changed too
+        """
+        if folders is None:
+            listed = set(os.listdir(ARTICLES_PATH))
+            # Folders deleted since the last update are looked at as well, to drop their documents
+            folders = sorted(listed | set(self.documents.keys()))
+
+        statuses = {"appended": 0, "unchanged": 0, "removed": 0}
+        pending = {}
+        missing = []
+        for folder in tqdm(folders):
+            path = stored_path(folder, "entities")
+            if path is None:
+                missing.append(folder)
+                continue
+
+            signature = file_signature(path)
+            if folder in self.documents and self.documents[folder][4] == signature:
+                statuses["unchanged"] += 1
+                continue
+
+            table_hash = file_hash(path)
+            if folder in self.documents and self.documents[folder][3] == table_hash:
+                # Written again with the same content
+                self.documents[folder][4] = signature
+                statuses["unchanged"] += 1
+                continue
+
+            pending[folder] = (to_arrow(read_entities(folder), ENTITIES_SCHEMA), table_hash, signature)
+            statuses["appended"] += 1
+            if len(pending) >= APPEND_DOCUMENTS:
+                self.append(pending)
+                pending = {}
+        self.append(pending)
+
+        for document in missing:
+            if document in self.documents:
+                del self.documents[document]
+                statuses["removed"] += 1
+        self._save_index()
+
+        if self.live_ratio() < COMPACT_RATIO:
+            self.compact()
+
+        return statuses
+
+    def live_ratio(self):
+        total = sum(self.index["segments"].values())
+        if total == 0:
+            return 1
+        return sum(entry[2] for entry in self.documents.values()) / total
+
+    def compact(self):
+        """
+        Rewrites the live rows in new segments, in document order, and deletes the former segments
+        """
+        old_segments = list(self.index["segments"].keys())
+        tables = {}
+        for document in sorted(self.documents.keys()):
+            segment, offset, rows, table_hash, signature = self.documents[document]
+            tables[document] = (self._segment(segment).slice(offset, rows), table_hash, signature)
+            if len(tables) >= APPEND_DOCUMENTS:
+                self.append(tables)
+                tables = {}
+        self.append(tables)
+
+        for segment in old_segments:
+            self.index["segments"].pop(segment, None)
+        self._save_index()
+
+        self._segments = {}
+        for segment in old_segments:
+            os.remove(self._segment_path(segment))
+
+    # -------------------------------------------------------------------------
+
+    def read_table(self, document, columns=None):
+        """
+        Arrow table of the entities of a document, a zero-copy slice of its segment
+        """
+        segment, offset, rows = self.documents[document][:3]
+        table = self._segment(segment).slice(offset, rows)
+        if columns is not None:
+            table = table.select(columns)
+        return table
+
+    def read_document(self, document, columns=None):
+        """
+        Entities of a single document, raises KeyError if the document is not in the store
+        """
+        return self.read_table(document, columns).to_pandas()
+
+    def _live_slices(self):
+        """
+        Documents in storage order: segment after segment, rows in the order they were written
+        """
+        return sorted(self.documents.items(), key=lambda x: (int(x[1][0]), x[1][1]))
+
+    def iter_documents(self, columns=None):
+        """
+        Yields every document with its entities, reading the segments sequentially
+        """
+        for document, _ in self._live_slices():
+            yield document, self.read_document(document, columns)
+
+    def read_all(self, columns=None):
+        """
+        Entities of the whole corpus in a single dataframe
+        """
+        tables = [self.read_table(document, columns) for document, _ in self._live_slices()]
+        if len(tables) == 0:
+            schema = ENTITIES_SCHEMA
+            if columns is not None:
+                schema = pa.schema([schema.field(column) for column in columns])
+            return schema.empty_table().to_pandas()
+        return pa.concat_tables(tables).unify_dictionaries().to_pandas()
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidates the entities of every article in the entity store")
+    parser.add_argument("--compact", action="store_true", help="Rewrites the segments without their garbage rows")
+    args = parser.parse_args()
+
+    store = EntityStore()
+    statuses = store.update()
+    if args.compact:
+        store.compact()
+    print(f"Entity store: {statuses['appended']} documents appended, {statuses['unchanged']} unchanged, "
+          f"{statuses['removed']} removed, {len(store)} documents in total")
@@ -0,0 +1,197 @@
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from network import HostRateLimiter, HTTPClient
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
+# ESearch and EFetch uilist both cap a single answer at 10000 ids
+MAX_IDS_PER_REQUEST = 10000
+
+# -----------------------------------------------------------------------------
+
+
+def _parse_date(pub_date):
+    """
+    Mirrors the date parsing done on the PubMed pages: year and abbreviated month, Undef otherwise
+    """
+    if pub_date is None:
+        return "Undef"
+
+    year = pub_date.findtext("Year")
+    month = pub_date.findtext("Month")
+    if year is not None and month is not None:
+        date_text = year + " " + month
+    else:
+        # MedlineDate looks like "2019 Jan-Feb"
+        date_text = pub_date.findtext("MedlineDate") or ""
+        date_text = " ".join(date_text.split(" ")[:2])[:8]
+
+    for date_format in ["%Y %b", "%Y %m"]:
+        try:
+            return datetime.strptime(date_text, date_format)
+        except ValueError:
+            pass
+    return "Undef"
+
+
+def _parse_article(article_soup):
+    """
+    Turns a PubmedArticle xml element into a row of articles_list
+    """
+    citation = article_soup.find("MedlineCitation")
+    article = citation.find("Article")
+
+    title_soup = article.find("ArticleTitle")
+    title = "".join(title_soup.itertext()) if title_soup is not None else ""
+
+    author_names = []
+    for author in article.findall("AuthorList/Author"):
+        if author.findtext("CollectiveName"):
+            author_names.append(author.findtext("CollectiveName"))
+        else:
+            name = " ".join(n for n in [author.findtext("ForeName"), author.findtext("LastName")] if n)
+            if name:
+                author_names.append(name)
+
+    return {"ID": citation.findtext("PMID"),
+            "Title": title,
+            "Authors": author_names,
+            "Date": _parse_date(article.find("Journal/JournalIssue/PubDate")),
+            "Citations": []}
+
+# -----------------------------------------------------------------------------
+
+
+class EUtilsClient():
+
+    def __init__(self, base_url=EUTILS_URL, api_key=None, email=None, batch_size=200, http=None):
+        """
+        Batched alternative to scraping the PubMed pages one at a time, using the NCBI E-utilities
+        Ids are posted once to the history server, metadata is then fetched batch_size articles per request
+        base_url can point to a local fake server, and http is anything with a post method like requests
+        """
+        self.base_url = base_url
+        self.batch_size = batch_size
+
+        self.params = {"db": "pubmed", "tool": "AL_Knowledge"}
+        if api_key:
+            self.params["api_key"] = api_key
+        if email:
+            self.params["email"] = email
+
+        if http is None:
+            # 3 requests per second without an API key, 10 with one
+            http = HTTPClient(rate_limiter=HostRateLimiter(requests_per_second=10 if api_key else 3, host_rates={}))
+        self.http = http
+
+    def _request(self, utility, **params):
+        """
+        Calls one of the utilities, parameters are always posted as id lists can get long
+        """
+        url = self.base_url + utility + ".fcgi"
+        response = self.http.post(url, data={**self.params, **params})
+        response.raise_for_status()
+        return response
+
+    def _batches(self, ids):
+        for i in range(0, len(ids), self.batch_size):
+            yield ids[i:i + self.batch_size]
+
+    def search(self, search_terms, max_results=None):
+        """
+        Gets all of the ids of articles matching a given list of search terms, English articles only
+        The search is stored on the history server, ids are then read back up to 10000 at a time
+        """
+        term = " AND ".join(search_terms) + " AND english[lang]"
+        root = ET.fromstring(self._request("esearch", term=term, usehistory="y", retmax=0).content)
+        count = int(root.findtext("Count"))
+        webenv = root.findtext("WebEnv")
+        query_key = root.findtext("QueryKey")
+        if max_results is not None:
+            count = min(count, max_results)
+
+        ids = []
+        for retstart in range(0, count, MAX_IDS_PER_REQUEST):
+            retmax = min(MAX_IDS_PER_REQUEST, count - retstart)
+            response = self._request("efetch", WebEnv=webenv, query_key=query_key, rettype="uilist",
+                                     retmode="text", retstart=retstart, retmax=retmax)
+            ids += [i for i in response.text.split() if i]
+
+        return ids[:count]
+
+    def post(self, ids):
+        """
+        Uploads a list of ids to the history server, returns its WebEnv and query key
+        """
+        root = ET.fromstring(self._request("epost", id=",".join(ids)).content)
+        return root.findtext("WebEnv"), root.findtext("QueryKey")
+
+    def fetch_articles(self, ids):
+        """
+        Returns the title, authors and date of every article, keyed by id, batch_size articles per request
+        """
+        articles = {}
+        if len(ids) == 0:
+            return articles
+
+        webenv, query_key = self.post(ids)
+        for retstart in range(0, len(ids), self.batch_size):
+            response = self._request("efetch", WebEnv=webenv, query_key=query_key, retmode="xml",
+                                     retstart=retstart, retmax=self.batch_size)
+            for article_soup in ET.fromstring(response.content).iter("PubmedArticle"):
+                row = _parse_article(article_soup)
+                articles[row["ID"]] = row
+
+        return articles
+
+    def _elink(self, ids, **params):
+        """
+        ELink answers once per id when the ids are given as separate id parameters, batch_size ids per request
+        """
+        for batch in self._batches(ids):
+            yield ET.fromstring(self._request("elink", dbfrom="pubmed", id=batch, **params).content)
+
+    def cited_by(self, ids):
+        """
+        Returns the ids of the articles citing each article
+        """
+        citations = {article_id: [] for article_id in ids}
+        for root in self._elink(ids, linkname="pubmed_pubmed_citedin"):
+            for link_set in root.iter("LinkSet"):
+                article_id = link_set.findtext("IdList/Id")
+                for link_db in link_set.findall("LinkSetDb"):
+                    citations[article_id] = [link.findtext("Id") for link in link_db.findall("Link")]
+
+        return citations
+
+    def full_text_links(self, ids):
+        """
+        Returns the url and the provider name of the full text of each article, when PubMed knows one
+        Provider names are the same as the source names used by DownloaderClass._get_text
+        """
+        links = {}
+        for root in self._elink(ids, cmd="prlinks"):
+            for id_url_set in root.iter("IdUrlSet"):
+                obj_url = id_url_set.find("ObjUrl")
+                if obj_url is not None:
+                    links[id_url_set.findtext("Id")] = (obj_url.findtext("Url"), obj_url.findtext("Provider/Name"))
+
+        return links
+
+    def get_articles(self, ids, full_text=True):
+        """
+        Gathers everything about a list of articles, with the same rows as articles_list in the scrapers
+        With full_text set, rows also get the FullTextURL and Source of the article
+        """
+        articles = self.fetch_articles(ids)
+        for article_id, citations_ids in self.cited_by(ids).items():
+            if article_id in articles:
+                articles[article_id]["Citations"] = citations_ids
+
+        if full_text:
+            links = self.full_text_links(ids)
+            for article_id, row in articles.items():
+                row["FullTextURL"], row["Source"] = links.get(article_id, (None, None))
+
+        return articles
@@ -0,0 +1,155 @@
+import os
+import argparse
+from tqdm.auto import tqdm
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from constants import *
+from storage import read_relations, has_table
+
+GRAPH_PATH = os.path.join(DATA_PATH, "cooccurrence.npz")
+VOCAB_PATH = os.path.join(DATA_PATH, "cooccurrence_vocab.tsv")
+
+# Edges are buffered as (row, column, weight) triplets, and summed into the graph every FLUSH_EDGES edges
+FLUSH_EDGES = 1000000
+
+RELATIONS_COLUMNS = ["FirstWord", "SecondWord", "FirstCUI", "SecondCUI", "Distance"]
+
+# -----------------------------------------------------------------------------
+
+
+def node_key(cui, word):
+    """
+    Linked entities are identified by their CUI, the others by their word
+    """
+    if isinstance(cui, str) and cui != "UNDEF":
+        return cui
+    return "W:" + str(word)
+
+
+def edge_weight(distances):
+    """
+    Entities right next to each other (or overlapping) weigh 1, then the weight decreases with the distance in words
+    """
+    return 1 / (1 + np.maximum(distances, 0))
+
+
+class CooccurrenceGraph():
+
+    def __init__(self, flush_edges=FLUSH_EDGES):
+        """
+        Undirected co-occurrence graph of the whole corpus, built one document at a time
+        Memory depends on the number of distinct nodes and edges, not on the number of documents
+        """
+        self.flush_edges = flush_edges
+
+        self.vocab = {}
+        self.labels = []
+        self.counts = []
+
+        self.matrix = sparse.csr_matrix((0, 0), dtype=np.float64)
+        self._rows = []
+        self._cols = []
+        self._weights = []
+        self._buffered = 0
+
+    def _node_ids(self, cuis, words):
+        ids = np.empty(len(cuis), dtype=np.int64)
+        for i, (cui, word) in enumerate(zip(cuis, words)):
+            key = node_key(cui, word)
+            node_id = self.vocab.get(key)
+            if node_id is None:
+                node_id = len(self.vocab)
+                self.vocab[key] = node_id
+                self.labels.append(str(word))
+                self.counts.append(0)
+            self.counts[node_id] += 1
+            ids[i] = node_id
+        return ids
+
+    def add_relations(self, relations_df):
+        """
+        Adds the relations of a document, the weights of an edge seen several times are summed
+        """
+        if len(relations_df) == 0:
+            return
+
+        first = self._node_ids(relations_df["FirstCUI"].values, relations_df["FirstWord"].values)
+        second = self._node_ids(relations_df["SecondCUI"].values, relations_df["SecondWord"].values)
+
+        # Only the upper triangle is accumulated, the graph is made symmetric when saved
+        self._rows.append(np.minimum(first, second))
+        self._cols.append(np.maximum(first, second))
+        self._weights.append(edge_weight(relations_df["Distance"].values.astype(np.float64)))
+        self._buffered += len(first)
+
+        if self._buffered >= self.flush_edges:
+            self.flush()
+
+    def flush(self):
+        """
+        Sums the buffered edges into the graph
+        """
+        n = len(self.vocab)
+        self.matrix.resize((n, n))
+        if self._buffered > 0:
+            buffered = sparse.coo_matrix((np.concatenate(self._weights),
+                                          (np.concatenate(self._rows), np.concatenate(self._cols))), shape=(n, n))
+            self.matrix = (self.matrix + buffered.tocsr()).tocsr()
+        self._rows, self._cols, self._weights = [], [], []
+        self._buffered = 0
+
+    def symmetric(self):
+        self.flush()
+        upper = self.matrix
+        return (upper + upper.T - sparse.diags(upper.diagonal())).tocsr()
+
+    def save(self, graph_path=GRAPH_PATH, vocab_path=VOCAB_PATH):
+        """
+        Saves the symmetric adjacency matrix, and the vocabulary: node id, key (CUI, or W:word), label (the first
+        word seen for the node) and number of relations involving it
+        """
+        sparse.save_npz(graph_path, self.symmetric())
+        nodes = sorted(self.vocab.items(), key=lambda x: x[1])
+        pd.DataFrame({"Id": [node_id for _, node_id in nodes],
+                      "Node": [key for key, _ in nodes],
+                      "Label": self.labels,
+                      "Count": self.counts}).to_csv(vocab_path, sep="\t", index=False)
+
+
+def load_graph(graph_path=GRAPH_PATH, vocab_path=VOCAB_PATH):
+    """
+    Returns the adjacency matrix and the vocabulary dataframe saved by CooccurrenceGraph.save
+    """
+    return sparse.load_npz(graph_path), pd.read_csv(vocab_path, sep="\t", keep_default_na=False)
+
+
+def build_cooccurrence_graph(filenames=None, flush_edges=FLUSH_EDGES):
+    """
+    Streams the relations of every article into the co-occurrence graph, only one document is loaded at a time
+    """
+    if filenames is None:
+        filenames = sorted(os.listdir(ARTICLES_PATH))
+
+    graph = CooccurrenceGraph(flush_edges)
+    for filename in tqdm(filenames):
+        if not has_table(filename, "relations"):
+            continue
+        graph.add_relations(read_relations(filename, columns=RELATIONS_COLUMNS))
+
+    return graph
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the corpus co-occurrence graph from the relations")
+    parser.add_argument("--flush_edges", type=int, default=FLUSH_EDGES,
+                        help="Number of edges buffered before being summed into the graph")
+    args = parser.parse_args()
+
+    graph = build_cooccurrence_graph(flush_edges=args.flush_edges)
+    graph.save()
+    print(f"Saved a graph of {len(graph.vocab)} nodes and {graph.matrix.nnz} edges to {GRAPH_PATH}")
@@ -0,0 +1,222 @@
+import os
+import re
+import gzip
+import time
+import sqlite3
+import hashlib
+import threading
+
+from constants import *
+
+CACHE_PATH = os.path.join(DATA_PATH, "http_cache")
+
+# Time to live of the cached pages, in seconds, the first matching class is used
+# Search results change as new articles are published, article pages and full texts rarely do
+URL_CLASSES = [
+    {"name": "search", "pattern": r"pubmed\.ncbi\.nlm\.nih\.gov/\?term=", "ttl": 24 * 3600},
+    {"name": "article", "pattern": r"pubmed\.ncbi\.nlm\.nih\.gov/[0-9]+", "ttl": 30 * 24 * 3600},
+    {"name": "publisher", "pattern": r".*", "ttl": 90 * 24 * 3600},
+]
+
+# Maximum size of the compressed bodies kept on disk, least recently used pages are evicted first
+MAX_CACHE_SIZE = 2 * 1024 ** 3
+
+# -----------------------------------------------------------------------------
+
+
+class CachedResponse():
+
+    def __init__(self, url, status_code, content, encoding=None, headers=None, from_cache=True):
+        """
+        Minimal stand-in for requests.Response, for pages served by the cache
+        """
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers or {}
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class HTTPCache():
+
+    def __init__(self, path=CACHE_PATH, url_classes=URL_CLASSES, max_size=MAX_CACHE_SIZE):
+        """
+        Content-addressed cache of the pages fetched from PubMed and the publishers
+        Bodies are stored gzipped under the sha256 of their content, identical pages are only stored once
+        The index maps every url to its body, along with the validators used to revalidate stale entries
+        """
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        self.url_classes = [(c["name"], re.compile(c["pattern"]), c["ttl"]) for c in url_classes]
+        self.max_size = max_size
+
+        os.makedirs(self.objects_path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                 url TEXT PRIMARY KEY,
+                                 key TEXT NOT NULL,
+                                 status INTEGER NOT NULL,
+                                 encoding TEXT,
+                                 etag TEXT,
+                                 last_modified TEXT,
+                                 fetched REAL NOT NULL,
+                                 accessed REAL NOT NULL,
+                                 size INTEGER NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.conn.commit()
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def _ttl(self, url):
+        for name, pattern, ttl in self.url_classes:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def _object_path(self, key):
+        return os.path.join(self.objects_path, key[:2], key + ".gz")
+
+    def _read_object(self, key):
+        with open(self._object_path(key), "rb") as f:
+            return gzip.decompress(f.read())
+
+    def _write_object(self, content):
+        """
+        Stores a body under its hash, returns the key and the compressed size
+        """
+        key = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(key)
+        if os.path.exists(object_path):
+            return key, os.path.getsize(object_path)
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        compressed = gzip.compress(content)
+        tmp_path = object_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(tmp_path, object_path)
+
+        return key, len(compressed)
+
+    def lookup(self, url):
+        """
+        Returns the cached response of a url and whether it is still fresh, or (None, False) if it is not cached
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT key, status, encoding, fetched FROM entries WHERE url = ?",
+                                    (url,)).fetchone()
+            if row is None:
+                return None, False
+            key, status, encoding, fetched = row
+            try:
+                content = self._read_object(key)
+            except (OSError, EOFError):
+                # Object evicted by another process or corrupted, the entry is unusable
+                self.conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self.conn.commit()
+                return None, False
+            self.conn.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time.time(), url))
+            self.conn.commit()
+
+        fresh = time.time() - fetched < self._ttl(url)
+        return CachedResponse(url, status, content, encoding=encoding), fresh
+
+    def _validators(self, url):
+        with self._lock:
+            row = self.conn.execute("SELECT etag, last_modified FROM entries WHERE url = ?", (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            etag, last_modified = row
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def _touch(self, url):
+        with self._lock:
+            now = time.time()
+            self.conn.execute("UPDATE entries SET fetched = ?, accessed = ? WHERE url = ?", (now, now, url))
+            self.conn.commit()
+
+    def store(self, url, content, status=200, encoding=None, etag=None, last_modified=None):
+        """
+        Adds or replaces the cached body of a url, then evicts pages if the cache grew too large
+        """
+        key, size = self._write_object(content)
+        with self._lock:
+            now = time.time()
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (url, key, status, encoding, etag, last_modified, now, now, size))
+            self.conn.commit()
+            self._evict()
+
+    def _evict(self):
+        """
+        Drops least recently used entries until the stored bodies fit in max_size
+        Objects shared by several urls are only deleted once no url points to them anymore
+        """
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT key, size FROM entries)"
+                                  ).fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        for url, key, size in self.conn.execute("SELECT url, key, size FROM entries ORDER BY accessed").fetchall():
+            self.conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+            if self.conn.execute("SELECT 1 FROM entries WHERE key = ? LIMIT 1", (key,)).fetchone() is None:
+                try:
+                    os.remove(self._object_path(key))
+                except OSError:
+                    pass
+                total -= size
+            if total <= self.max_size:
+                break
+        self.conn.commit()
+
+    def get(self, url, fetch):
+        """
+        Returns the page at url, from the cache when it is fresh
+        Stale pages are revalidated with their ETag/Last-Modified, and only downloaded again if they changed
+        fetch(url, headers) performs the actual request and returns a requests.Response
+        """
+        cached, fresh = self.lookup(url)
+        if cached is not None and fresh:
+            with self._lock:
+                self.hits += 1
+            return cached
+
+        headers = self._validators(url) if cached is not None else {}
+        response = fetch(url, headers=headers)
+
+        if cached is not None and response.status_code == 304:
+            with self._lock:
+                self.revalidated += 1
+            self._touch(url)
+            return cached
+
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200:
+            self.store(url, response.content, status=response.status_code,
+                       encoding=response.encoding or response.apparent_encoding,
+                       etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+        return response
+
+    def close(self):
+        self.conn.close()
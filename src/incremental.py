@@ -0,0 +1,62 @@
+import os
+import json
+import hashlib
+
+# -----------------------------------------------------------------------------
+# Helpers for the pipeline stages to skip the articles whose inputs did not change since their last run
+# Each stage keeps a small state file in the article folder, holding the hashes of what it was run on
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_hash(path):
+    """
+    Hash of the content of a file, read in chunks
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_signature(path):
+    """
+    Modification time and size of a file, to notice it changed without reading it
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def config_hash(config):
+    """
+    Hash of any json serializable configuration (pattern tables, model names and versions...)
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _state_path(article_path, stage):
+    return os.path.join(article_path, f".{stage}_state.json")
+
+
+def load_state(article_path, stage):
+    """
+    Returns the state saved by the last run of a stage on an article, None if it never ran
+    """
+    try:
+        with open(_state_path(article_path, stage), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(article_path, stage, state):
+    """
+    Saves the state of a stage, written to a temporary file first so a crash never leaves a half written state
+    """
+    path = _state_path(article_path, stage)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
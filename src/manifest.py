@@ -0,0 +1,98 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from constants import *
+
+MANIFEST_PATH = os.path.join(LOGS_PATH, "download_manifest.sqlite")
+
+# -----------------------------------------------------------------------------
+
+
+class DownloadManifest():
+
+    def __init__(self, path=MANIFEST_PATH):
+        """
+        Persistent record of every article the downloader went through
+        Each article is committed as soon as it is processed, so a crash only loses the articles in flight
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS articles (
+                                 id TEXT PRIMARY KEY,
+                                 status TEXT NOT NULL,
+                                 http_status INTEGER,
+                                 source TEXT,
+                                 content_hash TEXT,
+                                 title TEXT,
+                                 authors TEXT,
+                                 date TEXT,
+                                 citations TEXT,
+                                 message TEXT,
+                                 updated TEXT NOT NULL)""")
+        self.conn.commit()
+
+    def record(self, article_id, status, http_status=None, source=None, content_hash=None,
+               title=None, authors=None, date=None, citations=None, message=None):
+        """
+        Inserts or replaces the entry of an article, and commits it right away
+        status is either "downloaded", "failed" (no usable text) or "error" (exception while fetching)
+        """
+        if isinstance(date, datetime):
+            date = date.isoformat()
+        self.conn.execute("INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (article_id, status, http_status, source, content_hash, title,
+                           json.dumps(authors) if authors is not None else None, date,
+                           json.dumps(citations) if citations is not None else None, message,
+                           datetime.now().isoformat()))
+        self.conn.commit()
+
+    def statuses(self):
+        """
+        Maps every known article id to its status
+        """
+        return dict(self.conn.execute("SELECT id, status FROM articles"))
+
+    def pending(self, article_ids):
+        """
+        Splits article_ids between the ones needing a full download, and the ones that already have a raw.txt
+        on disk but no metadata in the manifest (only the PubMed page needs to be fetched for those)
+        Articles already downloaded are left out
+        """
+        statuses = self.statuses()
+        to_download = []
+        metadata_only = []
+        for article_id in article_ids:
+            has_raw = os.path.exists(os.path.join(ARTICLES_PATH, article_id, "raw.txt"))
+            if statuses.get(article_id) == "downloaded" and has_raw:
+                continue
+            elif has_raw and statuses.get(article_id) is None:
+                metadata_only.append(article_id)
+            else:
+                to_download.append(article_id)
+
+        return to_download, metadata_only
+
+    def citations_df(self, article_ids):
+        """
+        Rebuilds the citations dataframe of the downloaded articles from the manifest, in the order of article_ids
+        """
+        rows = {}
+        for article_id, title, authors, date, citations in self.conn.execute(
+                "SELECT id, title, authors, date, citations FROM articles WHERE status = 'downloaded'"):
+            if date is not None and date != "Undef":
+                date = datetime.fromisoformat(date)
+            rows[article_id] = {"ID": article_id,
+                                "Title": title,
+                                "Authors": json.loads(authors) if authors else [],
+                                "Date": date,
+                                "Citations": json.loads(citations) if citations else []}
+
+        articles_list = [rows[article_id] for article_id in article_ids if article_id in rows]
+        return pd.DataFrame(articles_list, columns=["ID", "Title", "Authors", "Date", "Citations"]).set_index("ID")
+
+    def close(self):
+        self.conn.close()
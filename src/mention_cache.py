@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import sqlite3
+from importlib.metadata import version
+
+import spacy
+from scispacy.candidate_generation import MentionCandidate
+
+from constants import *
+from incremental import config_hash
+
+MENTION_CACHE_PATH = os.path.join(DATA_PATH, "mention_cache.sqlite")
+
+# Maximum number of distinct mentions kept, least recently used ones are evicted first
+MAX_MENTIONS = 500000
+# The size of the cache is only checked every EVICT_EVERY new mentions
+EVICT_EVERY = 1000
+
+# -----------------------------------------------------------------------------
+
+
+def normalize_mention(text):
+    """
+    Key of a mention in the cache
+    The tfidf vectorizer of the linker lowercases the mentions and splits them on whitespace, so mentions
+    differing only in case or spacing always get the same candidates
+    """
+    return " ".join(text.lower().split())
+
+
+def linker_version(nlp, pipe_name="scispacy_linker"):
+    """
+    Hash of everything the linking decisions depend on: the model, the linker settings and the library versions
+    """
+    return config_hash({"model": nlp.meta.get("lang", "") + "_" + nlp.meta.get("name", ""),
+                        "model_version": nlp.meta.get("version"),
+                        "spacy": spacy.__version__,
+                        "scispacy": version("scispacy"),
+                        "linker": nlp.get_pipe_config(pipe_name)})
+
+
+class MentionCache():
+
+    def __init__(self, linker_version, path=MENTION_CACHE_PATH, max_entries=MAX_MENTIONS):
+        """
+        Persistent mention -> [(CUI, score, TUIs)] cache of the final decisions of the linker
+        Every entry is dropped when linker_version changes
+        The cache is used from forked NER workers: each process opens its own connection, and the hit counters
+        are kept in the database so the parent process can report on the whole run
+        """
+        self.path = path
+        self.linker_version = linker_version
+        self.max_entries = max_entries
+
+        self._conns = {}
+        self._new_entries = 0
+        self._check_version()
+
+    @property
+    def conn(self):
+        # Connections cannot cross a fork, the ones inherited from the parent are kept around but never used
+        pid = os.getpid()
+        if pid not in self._conns:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS mentions (
+                                key TEXT PRIMARY KEY,
+                                candidates TEXT NOT NULL,
+                                accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS mentions_accessed ON mentions (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.commit()
+            self._conns[pid] = conn
+        return self._conns[pid]
+
+    def _check_version(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        if row is None or row[0] != self.linker_version:
+            with self.conn:
+                self.conn.execute("DELETE FROM mentions")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.linker_version,))
+            self.reset_stats()
+
+    def get_many(self, keys):
+        """
+        Returns the cached candidates of the given keys, the ones missing are not in the dict
+        """
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(f"SELECT key, candidates FROM mentions WHERE key IN ({placeholders})",
+                                     batch).fetchall()
+            found.update((key, json.loads(candidates)) for key, candidates in rows)
+
+        if found:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany("UPDATE mentions SET accessed = ? WHERE key = ?",
+                                      [(now, key) for key in found])
+        return found
+
+    def put_many(self, entries):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO mentions VALUES (?, ?, ?)",
+                                  [(key, json.dumps(candidates), now) for key, candidates in entries.items()])
+
+        self._new_entries += len(entries)
+        if self._new_entries >= EVICT_EVERY:
+            self._new_entries = 0
+            self._evict()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM mentions").fetchone()[0]
+        if count > self.max_entries:
+            with self.conn:
+                self.conn.execute("DELETE FROM mentions WHERE key IN "
+                                  "(SELECT key FROM mentions ORDER BY accessed LIMIT ?)",
+                                  (count - self.max_entries,))
+
+    def record(self, hits, misses):
+        with self.conn:
+            for name, value in [("hits", hits), ("misses", misses)]:
+                self.conn.execute("INSERT INTO stats VALUES (?, ?) "
+                                  "ON CONFLICT(name) DO UPDATE SET value = value + ?", (name, value, value))
+
+    def reset_stats(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM stats")
+
+    def report(self):
+        """
+        Hits and misses of every process since the last reset, a hit being a mention linked without the linker
+        """
+        stats = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+        hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+        size = self.conn.execute("SELECT COUNT(*) FROM mentions").fetchone()[0]
+        return {"hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0,
+                "size": size}
+
+# -----------------------------------------------------------------------------
+
+
+class CachedCandidateGenerator():
+
+    def __init__(self, linker, cache):
+        """
+        Stands in for the candidate generator of a scispacy EntityLinker, answering from the cache when possible
+        Only the candidates the linker would keep are cached, and they are given back with their final score so
+        the linker makes the same decision again
+        """
+        self.linker = linker
+        self.generator = linker.candidate_generator
+        self.kb = self.generator.kb
+        self.cache = cache
+
+    def _decide(self, candidates):
+        """
+        Same filtering and ordering as EntityLinker.__call__
+        """
+        predicted = []
+        for candidate in candidates:
+            score = max(candidate.similarities)
+            entity = self.kb.cui_to_entity[candidate.concept_id]
+            if (self.linker.filter_for_definitions and entity.definition is None
+                    and score < self.linker.no_definition_threshold):
+                continue
+            if score > self.linker.threshold:
+                predicted.append((candidate.concept_id, float(score), list(entity.types)))
+        predicted.sort(reverse=True, key=lambda x: x[1])
+        return predicted[:self.linker.max_entities_per_mention]
+
+    def __call__(self, mention_texts, k):
+        keys = [normalize_mention(text) for text in mention_texts]
+        decisions = self.cache.get_many(set(keys))
+
+        missing = sorted(set(keys) - set(decisions))
+        if missing:
+            new_decisions = {key: self._decide(candidates)
+                             for key, candidates in zip(missing, self.generator(missing, k))}
+            self.cache.put_many(new_decisions)
+            decisions.update(new_decisions)
+        self.cache.record(len(keys) - len(missing), len(missing))
+
+        return [[MentionCandidate(concept_id=cui, aliases=[text], similarities=[score])
+                 for cui, score, types in decisions[key]]
+                for key, text in zip(keys, mention_texts)]
+
+
+def use_mention_cache(nlp, pipe_name="scispacy_linker", path=MENTION_CACHE_PATH, max_entries=MAX_MENTIONS):
+    """
+    Puts the mention cache in front of the candidate generator of the linker of a model, returns the cache
+    """
+    linker = nlp.get_pipe(pipe_name)
+    cache = MentionCache(linker_version(nlp, pipe_name), path, max_entries)
+    linker.candidate_generator = CachedCandidateGenerator(linker, cache)
+    return cache
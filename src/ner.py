@@ -1,19 +1,40 @@
 import os
-import time
+import gc
 import re
+import inspect
+from bisect import bisect_left, bisect_right
 from tqdm.auto import tqdm
 
 import pandas as pd
 import spacy
-import scispacy
-from scispacy.linking import EntityLinker
-from scispacy.abbreviation import AbbreviationDetector
+import scispacy.abbreviation  # noqa: F401 Registers the abbreviation_detector pipe
 
 from constants import *
+from offsets import OffsetIndex
+from umls import SemanticGroupLookup
+from incremental import file_hash, config_hash, load_state, save_state
+from storage import write_entities, remove_table
+from entity_store import EntityStore
+import shared_linker  # noqa: F401 Registers the shared_scispacy_linker pipe
+from mention_cache import use_mention_cache
 
 import warnings
 warnings.filterwarnings("ignore")
 
+# Documents are split in chunks of whole paragraphs of at most MAX_CHUNK_CHARS characters, and sent to the spacy
+# models BATCH_SIZE chunks at a time, over N_PROCESS processes
+BATCH_SIZE = 32
+N_PROCESS = 4
+MAX_CHUNK_CHARS = 100000
+
+# Components of each packaged pipeline needed for what is kept from the docs (ents and lemma_), every other
+# component is excluded at load time. The rule based lemmatizers need the tags, hence the tagger and attribute_ruler.
+# Sentence boundaries come from a sentencizer instead of the parser.
+SPACY_COMPONENTS = {
+    "en_core_sci_md": ["tok2vec", "tagger", "attribute_ruler", "lemmatizer", "ner"],
+    "en_core_web_md": ["tok2vec", "tagger", "attribute_ruler", "lemmatizer", "ner"],
+}
+
 # -----------------------------------------------------------------------------
 
 # Manual Models
@@ -32,40 +53,29 @@ def names_et_al(text):
 # -----------------------------------------------------------------------------
 
 
-def get_entities_from_spacy(text, model, name, filename):
+def get_entities_from_doc(doc, semantic_lookup, name, filename, offset=0):
     """
-    Uses a spacy model to return all entities found
+    Returns all entities found in a spacy doc
+    semantic_lookup maps the linked CUIs to their semantic group, None for models without linker
+    offset is the position of the doc in the full text, when the text was split in chunks
     """
-    doc = model(text)
     entities = list(doc.ents)
     entities.sort(key=lambda x: x.start_char)
 
     entities_list = []
-    try:
-        linker = model.get_pipe("scispacy_linker")
-        scispacy_m = True
-    except:
-        linker = None
-        scispacy_m = False
 
     for ent in entities:
         word = ent.lemma_
         e_type = ent.label_
-        source = name
-        start_char = ent.start_char
-        end_char = ent.end_char
+        start_char = ent.start_char + offset
+        end_char = ent.end_char + offset
         document = filename.split('.')[0]
         try:
             CUI, score = ent._.kb_ents[0]
         except:
             CUI, score = None, None
         if CUI and score:
-            TUI = re.search(r"T[0-9]{3}", str(linker.kb.cui_to_entity[CUI]))[0]
-            e_type, group = None, None
-            e_type = TUI_MAP[TUI]
-            group = TUI_MAP[TUI]
-        else:
-            TUI, group = None, None
+            _, e_type = semantic_lookup(CUI)
 
         entities_list.append({"Word": word,
                               "Type": e_type,
@@ -77,6 +87,130 @@ def get_entities_from_spacy(text, model, name, filename):
     return entities_list
 
 
+def load_spacy_model(package, components=None):
+    """
+    Loads a packaged spacy pipeline with only the components declared in SPACY_COMPONENTS (or given),
+    and a sentencizer where the parser used to provide sentence boundaries
+    """
+    if components is None:
+        components = SPACY_COMPONENTS[package]
+    # "pipeline" only lists the enabled components, disabled ones (like the senter) would still be loaded
+    packaged = spacy.util.get_model_meta(spacy.util.get_package_path(package))["components"]
+    exclude = [component for component in packaged if component not in components]
+
+    nlp = spacy.load(package, exclude=exclude)
+    if not any(component in nlp.pipe_names for component in ["parser", "senter", "sentencizer"]):
+        if "ner" in nlp.pipe_names:
+            # The ner does not start entities across sentence starts, it has to see them like it did with the parser
+            nlp.add_pipe("sentencizer", before="ner")
+        else:
+            nlp.add_pipe("sentencizer")
+
+    return nlp
+
+
+# One lookup per linker, shared by every document
+_semantic_lookups = {}
+
+
+def get_semantic_lookup(model):
+    """
+    CUI -> semantic group lookup of the linker of a model, None if the model has no linker
+    """
+    try:
+        linker = model.get_pipe("scispacy_linker")
+    except KeyError:
+        return None
+    if id(linker) not in _semantic_lookups:
+        _semantic_lookups[id(linker)] = SemanticGroupLookup(linker.kb)
+    return _semantic_lookups[id(linker)]
+
+
+def save_semantic_lookups():
+    for semantic_lookup in _semantic_lookups.values():
+        semantic_lookup.save()
+
+
+def get_entities_from_spacy(text, model, name, filename):
+    """
+    Uses a spacy model to return all entities found
+    """
+    return get_entities_from_doc(model(text), get_semantic_lookup(model), name, filename)
+
+
+def chunk_text(text, max_chars=MAX_CHUNK_CHARS):
+    """
+    Splits a text in chunks of whole paragraphs, each one up to max_chars long (unless a single paragraph is longer)
+    Returns the chunks along with their offset in the text
+    """
+    chunks = []
+    start = 0
+    end = 0
+    while end < len(text):
+        paragraph_end = text.find("\n", end)
+        paragraph_end = len(text) if paragraph_end == -1 else paragraph_end + 1
+        if paragraph_end - start > max_chars and end > start:
+            chunks.append((start, text[start:end]))
+            start = end
+        end = paragraph_end
+    if end > start or len(chunks) == 0:
+        chunks.append((start, text[start:end]))
+
+    return chunks
+
+
+def read_clean_text(filename):
+    with open(os.path.join(ARTICLES_PATH, filename, "clean.txt"), "r") as f:
+        return f.read()
+
+
+def _iter_chunks(filenames, max_chars):
+    """
+    Chunks of every document, with the document name, the offset of the chunk and whether it is the last one
+    """
+    for filename in filenames:
+        chunks = chunk_text(read_clean_text(filename), max_chars)
+        for i, (offset, chunk) in enumerate(chunks):
+            yield chunk, (filename, offset, i == len(chunks) - 1)
+
+
+def run_spacy_models(filenames, ner_models, batch_size=BATCH_SIZE, n_process=N_PROCESS, max_chars=MAX_CHUNK_CHARS):
+    """
+    Runs every spacy model over all the documents with nlp.pipe, batch_size chunks at a time over n_process processes
+    Long documents are split on paragraph boundaries, and entity offsets are mapped back to the full text
+    Yields each document name with the entities found by each model, as soon as all of its chunks are processed,
+    along with its word and sentence index built from the doc of the first spacy model
+    """
+    spacy_models = [model for model in ner_models if model["type"] == "Spacy"]
+    if len(spacy_models) == 0:
+        for filename in filenames:
+            yield filename, {}, OffsetIndex.from_text(read_clean_text(filename))
+        return
+
+    if n_process > 1:
+        # The workers are forked: frozen objects are never touched by their garbage collector, so the pages holding
+        # the linker index stay shared instead of being copied in every worker
+        gc.freeze()
+
+    streams = [model["model"].pipe(_iter_chunks(filenames, max_chars), as_tuples=True,
+                                   batch_size=batch_size, n_process=n_process)
+               for model in spacy_models]
+    semantic_lookups = [get_semantic_lookup(model["model"]) for model in spacy_models]
+
+    doc_entities = {model["name"]: [] for model in spacy_models}
+    doc_offsets = []
+    for outputs in zip(*streams):
+        filename, offset, last = outputs[0][1]
+        for model, semantic_lookup, (doc, _) in zip(spacy_models, semantic_lookups, outputs):
+            doc_entities[model["name"]] += get_entities_from_doc(doc, semantic_lookup, model["name"], filename,
+                                                                 offset)
+        doc_offsets.append((outputs[0][0], offset))
+        if last:
+            yield filename, doc_entities, OffsetIndex.from_docs(doc_offsets)
+            doc_entities = {model["name"]: [] for model in spacy_models}
+            doc_offsets = []
+
+
 def get_entities_from_manual(text, model, name, filename):
     """
     Uses a manual model to return all entities found
@@ -87,7 +221,6 @@ def get_entities_from_manual(text, model, name, filename):
     entities_list = []
 
     for word in words_list:
-        source = name
         start_char, end_char = re.search(word, text).span()
         document = filename.split('.')[0]
         entities_list.append({"Word": word,
@@ -101,86 +234,196 @@ def get_entities_from_manual(text, model, name, filename):
     return entities_list
 
 
-def build_merged_entities_df(filename, ner_models):
+class IntervalSet():
+
+    def __init__(self):
+        """
+        Union of [start, end) character intervals, kept as sorted lists of disjoint intervals
+        """
+        self.starts = []
+        self.ends = []
+
+    def overlaps(self, start, end):
+        """
+        Whether any character of [start, end) is already covered, empty intervals never overlap
+        """
+        if start >= end:
+            return False
+        # Last interval starting at or before start, then the first one starting after it
+        i = bisect_right(self.starts, start) - 1
+        if i >= 0 and self.ends[i] > start:
+            return True
+        return i + 1 < len(self.starts) and self.starts[i + 1] < end
+
+    def add(self, start, end):
+        """
+        Covers [start, end), merging it with the intervals it overlaps or touches
+        """
+        if start >= end:
+            return
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+
+def merge_entities(entities_lists):
+    """
+    Merges the entities found by each model, given in priority order
+    Until an entity is kept, every entity of a model is kept. After that, entities of the following models are
+    only kept if none of their characters is covered by an entity already kept
+    """
+    covered = IntervalSet()
+    merged = []
+
+    for entities_list in entities_lists:
+        if len(merged) > 0:
+            for ent in entities_list:
+                if not covered.overlaps(ent["StartChar"], ent["EndChar"]):
+                    merged.append(ent)
+                    covered.add(ent["StartChar"], ent["EndChar"])
+        else:
+            for ent in entities_list:
+                covered.add(ent["StartChar"], ent["EndChar"])
+            merged += entities_list
+
+    return merged
+
+
+def build_merged_entities_df(filename, ner_models, text=None, spacy_entities=None, index=None):
     """
     Merges all results from all models to create a final dataframe of entities
+    spacy_entities optionally holds the entities already found by each spacy model, as given by run_spacy_models
+    Word and sentence ids come from index, or from an index built on the text alone if not given
     """
-    with open(os.path.join(ARTICLES_PATH, filename, "clean.txt"), "r") as f:
-        text = f.read()
+    if text is None:
+        text = read_clean_text(filename)
 
-    entities_df = pd.DataFrame()
-    seen = [0] * len(text)
+    entities_lists = []
 
     for model in ner_models:
         model_type = model["type"]
         model_name = model["name"]
-        model_prio = model["prio"]
         model_nlp = model["model"]
-        if model_type == "Spacy":
+        if model_type == "Spacy" and spacy_entities is not None:
+            entities_list = spacy_entities[model_name]
+        elif model_type == "Spacy":
             entities_list = get_entities_from_spacy(text, model_nlp, model_name, filename)
         elif model_type == "Manual":
             entities_list = get_entities_from_manual(text, model_nlp, model_name, filename)
         else:
             raise NotImplementedError(f"Model type {model_type} is unknown.")
+        entities_lists.append(entities_list)
 
-        if len(entities_df) > 0:
-            good_entities = []
-            for ent in entities_list:
-                if sum(seen[ent["StartChar"]:ent["EndChar"]]) == 0:
-                    good_entities.append(ent)
-                    seen[ent["StartChar"]:ent["EndChar"]] = [1] * (ent["EndChar"] - ent["StartChar"])
-            entities_df = pd.concat([entities_df, pd.DataFrame(good_entities)])
-        else:
-            for ent in entities_list:
-                seen[ent["StartChar"]:ent["EndChar"]] = [1] * (ent["EndChar"] - ent["StartChar"])
-            entities_df = pd.DataFrame(entities_list)
+    entities_df = pd.DataFrame(merge_entities(entities_lists))
 
     if len(entities_df) != 0:
         entities_df = entities_df.sort_values(by=["Document", "StartChar"], axis=0).reset_index(drop=True)
 
-    text = re.sub("[^a-zA-Z0-9\.]", " ", text)
+    if index is None:
+        index = OffsetIndex.from_text(text)
 
     if len(entities_df) > 0:
-        cursor = 0
-        cnt_words = 0
-        cnt_sentences = 0
-        words_dicts = []
-        for word, start_char, end_char in list(entities_df[["Word", "StartChar", "EndChar"]].itertuples(index=False, name=None)):
-            cnt_words += sum([len(a) > 0 for a in text[cursor:start_char].split(" ")])
-            cnt_sentences += sum([a == "." for a in text[cursor:start_char]])
-            start_id = cnt_words
-            sentence_id = cnt_sentences
-            num_words = sum([len(a) > 0 for a in word.split(" ")])
-            end_id = start_id + num_words - 1
-            cnt_words += num_words
-            words_dicts.append({"Word": word, "StartWord": start_id, "EndWord": end_id, "Sentence": sentence_id})
-            cursor = end_char
-        words_df = pd.DataFrame(words_dicts)
-
-        entities_df = pd.concat([entities_df, words_df[["StartWord", "EndWord", "Sentence"]]], axis=1)
+        start_words, end_words, sentences = index.map(entities_df["StartChar"].values, entities_df["EndChar"].values)
+        entities_df["StartWord"] = start_words
+        entities_df["EndWord"] = end_words
+        entities_df["Sentence"] = sentences
 
     return entities_df
 
+
+def models_version(ner_models):
+    """
+    Hash of everything the entities depend on: the name, priority and settings of every model, with the package
+    version and components of the spacy pipelines (linker included), and the code of the manual models
+    """
+    config = []
+    for model in ner_models:
+        entry = {"type": model["type"], "name": model["name"], "prio": model["prio"]}
+        if model["type"] == "Spacy":
+            nlp = model["model"]
+            entry["package"] = nlp.meta.get("lang", "") + "_" + nlp.meta.get("name", "")
+            entry["version"] = nlp.meta.get("version")
+            entry["pipeline"] = {name: nlp.get_pipe_config(name) for name in nlp.pipe_names}
+        elif model["type"] == "Manual":
+            entry["source"] = inspect.getsource(model["model"])
+        config.append(entry)
+
+    return config_hash(config)
+
+
+def pending_documents(filenames, version):
+    """
+    Splits the documents between the ones NER has to run on, with the state to save once done, the ones already
+    up to date with their clean.txt and the models, and the ones without clean.txt
+    """
+    pending = {}
+    up_to_date = []
+    missing = []
+    for filename in filenames:
+        article_path = os.path.join(ARTICLES_PATH, filename)
+        clean_path = os.path.join(article_path, "clean.txt")
+        if not os.path.exists(clean_path):
+            missing.append(filename)
+            continue
+
+        state = {"clean": file_hash(clean_path), "models": version}
+        if load_state(article_path, "ner") == state:
+            up_to_date.append(filename)
+        else:
+            pending[filename] = state
+
+    return pending, up_to_date, missing
+
 # -----------------------------------------------------------------------------
 
 
-nlp_scispacy = spacy.load("en_core_sci_md")
-nlp_scispacy.add_pipe("abbreviation_detector")
-nlp_scispacy.add_pipe("scispacy_linker", config={"resolve_abbreviations": True,
-                      "linker_name": "umls", "max_entities_per_mention": 1})
+if __name__ == "__main__":
+    nlp_scispacy = load_spacy_model("en_core_sci_md")
+    # Abbreviations are kept as plain text, so the docs can be sent back from the NER worker processes
+    nlp_scispacy.add_pipe("abbreviation_detector", config={"make_serializable": True})
+    nlp_scispacy.add_pipe("shared_scispacy_linker", name="scispacy_linker",
+                          config={"resolve_abbreviations": True, "linker_name": "umls",
+                                  "max_entities_per_mention": 1})
+    mention_cache = use_mention_cache(nlp_scispacy)
+    mention_cache.reset_stats()
 
-ner_models = [
-    {"type": "Spacy", "name": "SciSpacy MD", "prio": 0, "model": nlp_scispacy},
-    {"type": "Spacy", "name": "Spacy SM", "prio": 1, "model": spacy.load("en_core_web_md")},
-    {"type": "Manual", "name": "Names et al.", "prio": -1, "model": names_et_al}
-]
+    ner_models = [
+        {"type": "Spacy", "name": "SciSpacy MD", "prio": 0, "model": nlp_scispacy},
+        {"type": "Spacy", "name": "Spacy SM", "prio": 1, "model": load_spacy_model("en_core_web_md")},
+        {"type": "Manual", "name": "Names et al.", "prio": -1, "model": names_et_al}
+    ]
 
-ner_models.sort(key=lambda x: x["prio"])
+    ner_models.sort(key=lambda x: x["prio"])
 
-for filename in tqdm(os.listdir(ARTICLES_PATH)):
-    entities_df = build_merged_entities_df(filename, ner_models)
-    entities_df.fillna(value="UNDEF", inplace=True)
+    pending, up_to_date, missing = pending_documents(sorted(os.listdir(ARTICLES_PATH)), models_version(ner_models))
+    print(f"NER on {len(pending)} articles, {len(up_to_date)} already up to date, {len(missing)} without clean.txt")
 
-    if len(entities_df) != 0:
-        with open(os.path.join(ARTICLES_PATH, filename, "entities.csv"), "wb") as f:
-            entities_df.to_csv(f)
+    filenames = list(pending.keys())
+    for filename, spacy_entities, index in tqdm(run_spacy_models(filenames, ner_models), total=len(filenames)):
+        article_path = os.path.join(ARTICLES_PATH, filename)
+        entities_df = build_merged_entities_df(filename, ner_models, spacy_entities=spacy_entities, index=index)
+        entities_df.fillna(value="UNDEF", inplace=True)
+
+        if len(entities_df) != 0:
+            write_entities(filename, entities_df)
+        else:
+            # Entities of a previous version of the text
+            remove_table(filename, "entities")
+
+        # CUIs first seen in this article are persisted before it is marked as done, so a crash never leaves
+        # up to date entities whose CUIs are missing from the lookup
+        save_semantic_lookups()
+        save_state(article_path, "ner", pending[filename])
+
+    # The new entities go straight to the entity store, the articles of an interrupted run are caught up by the
+    # next update of the store since their tables changed
+    statuses = EntityStore().update(filenames)
+    print(f"Entity store: {statuses['appended']} documents appended, {statuses['removed']} removed")
+
+    stats = mention_cache.report()
+    print(f"Mention cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), "
+          f"{stats['size']} mentions cached")
@@ -0,0 +1,87 @@
+import os
+import time
+import argparse
+import tracemalloc
+import multiprocessing as mp
+
+import spacy
+
+from constants import *
+from ner import SPACY_COMPONENTS, load_spacy_model, read_clean_text
+
+# -----------------------------------------------------------------------------
+# Measures what excluding the unused components of the spacy pipelines saves, per document
+# Each configuration runs in a fresh process so the memory of one does not leak into the other
+
+
+def _rss_mb():
+    """
+    Resident memory of the current process, Linux only
+    """
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def _profile(package, trimmed, filenames, queue):
+    rss_start = _rss_mb()
+    start = time.perf_counter()
+    nlp = load_spacy_model(package) if trimmed else spacy.load(package)
+    load_time = time.perf_counter() - start
+    rss_loaded = _rss_mb()
+
+    texts = [read_clean_text(filename) for filename in filenames]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for doc in nlp.pipe(texts):
+        pass
+    doc_time = (time.perf_counter() - start) / max(len(texts), 1)
+    doc_peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+
+    queue.put({"pipeline": nlp.pipe_names,
+               "load_time": load_time,
+               "model_memory": rss_loaded - rss_start,
+               "doc_time": doc_time,
+               "peak_memory": doc_peak,
+               "final_memory": _rss_mb() - rss_start})
+
+
+def profile(package, trimmed, filenames):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_profile, args=(package, trimmed, filenames, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports the time and memory saved by the trimmed spacy pipelines")
+    parser.add_argument("--num_docs", type=int, default=50, help="Number of articles to run the pipelines on")
+
+    args = parser.parse_args()
+    filenames = [filename for filename in sorted(os.listdir(ARTICLES_PATH))
+                 if os.path.exists(os.path.join(ARTICLES_PATH, filename, "clean.txt"))][:args.num_docs]
+
+    for package in SPACY_COMPONENTS.keys():
+        full = profile(package, False, filenames)
+        trimmed = profile(package, True, filenames)
+
+        print(f"\n{package} on {len(filenames)} documents")
+        print(f"  Full pipeline:    {', '.join(full['pipeline'])}")
+        print(f"  Trimmed pipeline: {', '.join(trimmed['pipeline'])}")
+        for key, label, unit in [("load_time", "Load time", "s"),
+                                 ("model_memory", "Model memory", "MB"),
+                                 ("doc_time", "Time per document", "s"),
+                                 ("peak_memory", "Peak allocations while processing", "MB"),
+                                 ("final_memory", "Resident memory after processing", "MB")]:
+            saved = full[key] - trimmed[key]
+            ratio = saved / full[key] * 100 if full[key] else 0
+            print(f"  {label}: {full[key]:.3f}{unit} -> {trimmed[key]:.3f}{unit} (saved {saved:.3f}{unit}, {ratio:.0f}%)")
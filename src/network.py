@@ -0,0 +1,240 @@
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# -----------------------------------------------------------------------------
+
+# Requests per second allowed for a single host, unless overriden in host_rates
+# NCBI asks for at most 3 requests per second without an API key
+DEFAULT_REQUESTS_PER_SECOND = 2
+HOST_RATES = {"pubmed.ncbi.nlm.nih.gov": 3}
+
+# -----------------------------------------------------------------------------
+
+
+class HostRateLimiter():
+
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, host_rates=HOST_RATES):
+
+        self.requests_per_second = requests_per_second
+        self.host_rates = host_rates
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def _interval(self, host):
+        """
+        Minimal time between two requests to the same host, 0 if not limited
+        """
+        rate = self.host_rates.get(host, self.requests_per_second)
+        if not rate:
+            return 0
+        return 1 / rate
+
+    def wait(self, url):
+        """
+        Blocks until a new request to the host of the url is allowed
+        Slots are reserved under the lock, but the sleep happens outside of it so other hosts are not delayed
+        """
+        host = urlparse(url).netloc
+        interval = self._interval(host)
+        if interval == 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+# -----------------------------------------------------------------------------
+
+# Statuses worth retrying, anything else is returned to the caller as is
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Hosts every article depends on: requests to them wait for the circuit to close again instead of failing
+WAIT_HOSTS = ["pubmed.ncbi.nlm.nih.gov", "eutils.ncbi.nlm.nih.gov"]
+# Seconds between two checks of an open circuit
+WAIT_POLL = 10
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker():
+
+    def __init__(self, failure_threshold=5, reset_timeout=300, wait_hosts=WAIT_HOSTS):
+        """
+        Stops sending requests to a host after failure_threshold consecutive failures
+        After reset_timeout seconds a single trial request is let through, closing the circuit again if it succeeds
+        Requests to wait_hosts are held back until then instead of failing, see wait
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.wait_hosts = wait_hosts
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened_at = {}
+
+    def allow(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at >= self.reset_timeout:
+                # Half open, the next failure opens the circuit again for reset_timeout
+                self._opened_at[host] = time.monotonic()
+                return True
+            return False
+
+    def record_success(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            self._failures[host] = 0
+            self._opened_at.pop(host, None)
+
+    def record_failure(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._failures[host] >= self.failure_threshold:
+                self._opened_at[host] = time.monotonic()
+
+    def wait(self, url):
+        """
+        Returns once a request to the host of url is allowed
+        Raises CircuitOpenError right away if the circuit of the host is open and the host is not in wait_hosts
+        """
+        host = urlparse(url).netloc
+        waiting = False
+        while not self.allow(url):
+            if host not in self.wait_hosts:
+                raise CircuitOpenError(f"{host} failed too many times, not contacted")
+            if not waiting:
+                print(f"{host} is unavailable, waiting up to {self.reset_timeout}s before trying again...")
+                waiting = True
+            # Polled, so waiting requests go through as soon as the trial request closes the circuit
+            time.sleep(WAIT_POLL + random.uniform(0, 1))
+
+    def open_hosts(self):
+        with self._lock:
+            return list(self._opened_at.keys())
+
+    def call(self, url, function, *args, **kwargs):
+        """
+        Runs function behind the breaker of the host of url, any exception counts as a failure
+        """
+        self.wait(url)
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.record_failure(url)
+            raise
+        self.record_success(url)
+        return result
+
+
+def _retry_after(response):
+    """
+    Delay asked by the server through the Retry-After header, in seconds, None if absent or unreadable
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPClient():
+
+    def __init__(self, rate_limiter=None, breaker=None, pool_size=16, timeout=30, max_retries=6,
+                 backoff_base=1, backoff_max=60):
+        """
+        Shared HTTP client: keep-alive connections pooled per host, per host rate limiting and circuit breaking,
+        and retries with jittered exponential backoff (or the delay asked by Retry-After)
+        """
+        if rate_limiter is None:
+            rate_limiter = HostRateLimiter()
+        self.rate_limiter = rate_limiter
+        if breaker is None:
+            breaker = CircuitBreaker()
+        self.breaker = breaker
+
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _backoff(self, attempt):
+        """
+        Full jitter: uniform between 0 and the exponential delay, so retrying workers do not synchronize
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request, retrying network errors and RETRY_STATUSES up to max_retries times
+        Only a request whose retries all failed counts as a failure for the circuit breaker. If the host failed
+        too many times recently, raises CircuitOpenError without contacting it, or waits for it (breaker.wait_hosts)
+        The last response is returned if the retries run out on an error status, the last exception is raised
+        if they run out on network errors
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        response = None
+        error = None
+
+        self.breaker.wait(url)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait(url)
+            try:
+                response = self.session.request(method, url, **kwargs)
+                error = None
+            except requests.RequestException as e:
+                response = None
+                error = e
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                self.breaker.record_success(url)
+                return response
+
+            if attempt == self.max_retries:
+                self.breaker.record_failure(url)
+                break
+
+            delay = _retry_after(response) if response is not None else None
+            if delay is None:
+                delay = self._backoff(attempt)
+            else:
+                delay = min(delay, self.backoff_max * 5)
+            print(url + f" - Network error, retrying in {delay:.1f}s... ({attempt + 1})")
+            time.sleep(delay)
+
+        if response is not None:
+            return response
+        raise error
+
+    def get(self, url, headers=None, stream=False, **kwargs):
+        return self.request("GET", url, headers=headers, stream=stream, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
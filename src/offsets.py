@@ -0,0 +1,71 @@
+import re
+
+import numpy as np
+
+# -----------------------------------------------------------------------------
+
+
+class OffsetIndex():
+
+    def __init__(self, token_starts, token_ends, sentence_starts):
+        """
+        Character offsets of the words and sentences of a document, sorted
+        Entities are mapped to word and sentence ids with binary searches
+        """
+        self.token_starts = np.asarray(token_starts, dtype=np.int64)
+        self.token_ends = np.asarray(token_ends, dtype=np.int64)
+        sentence_starts = np.asarray(sentence_starts, dtype=np.int64)
+        if len(sentence_starts) == 0 or sentence_starts[0] != 0:
+            sentence_starts = np.concatenate([[0], sentence_starts])
+        self.sentence_starts = sentence_starts
+
+    @staticmethod
+    def doc_offsets(doc, offset=0):
+        """
+        Words (punctuation and spaces left out) and sentence starts of a spacy doc, shifted by offset
+        """
+        words = [token for token in doc if not token.is_punct and not token.is_space]
+        token_starts = [token.idx + offset for token in words]
+        token_ends = [token.idx + len(token.text) + offset for token in words]
+        if doc.has_annotation("SENT_START"):
+            sentence_starts = [sent.start_char + offset for sent in doc.sents]
+        else:
+            sentence_starts = [offset]
+        return token_starts, token_ends, sentence_starts
+
+    @classmethod
+    def from_docs(cls, docs):
+        """
+        Index of a document processed in chunks, docs being a list of (spacy doc, offset of the chunk)
+        """
+        token_starts, token_ends, sentence_starts = [], [], []
+        for doc, offset in docs:
+            starts, ends, sentences = cls.doc_offsets(doc, offset)
+            token_starts += starts
+            token_ends += ends
+            sentence_starts += sentences
+        return cls(token_starts, token_ends, sentence_starts)
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Index built without a spacy doc: words are runs of letters, digits and dots, and sentences end with a dot
+        """
+        sanitized = re.sub(r"[^a-zA-Z0-9\.]", " ", text)
+        words = [match.span() for match in re.finditer(r"\S+", sanitized)]
+        sentence_starts = [0] + [match.end() for match in re.finditer(r"\.", sanitized)]
+        return cls([start for start, _ in words], [end for _, end in words], sentence_starts)
+
+    def map(self, start_chars, end_chars):
+        """
+        Returns the first word, last word and sentence ids of entities given by their character offsets
+        The first word is the first one ending after the entity start, the last word the last one starting before its end
+        """
+        start_chars = np.asarray(start_chars, dtype=np.int64)
+        end_chars = np.asarray(end_chars, dtype=np.int64)
+
+        start_words = np.searchsorted(self.token_ends, start_chars, side="right")
+        end_words = np.maximum(np.searchsorted(self.token_starts, end_chars, side="left") - 1, start_words)
+        sentences = np.searchsorted(self.sentence_starts, start_chars, side="right") - 1
+
+        return start_words, end_words, sentences
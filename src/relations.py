@@ -1,18 +1,21 @@
 import os
-import time
-import re
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.auto import tqdm
 
+import numpy as np
 import pandas as pd
 
 from constants import *
+from umls import SemanticGroupLookup
+from incremental import file_hash, config_hash, load_state, save_state
+from storage import read_entities, write_relations, stored_path, remove_table
 
 # -----------------------------------------------------------------------------
 
 MAX_DIST = 20
 
-relations_dicts = []
-
 # -----------------------------------------------------------------------------
 
 
@@ -20,51 +23,197 @@ with open(os.path.join(ROOT_PATH, "data", "2021AB_SN", "SRSTRE1")) as f:
     umls_relations_df = pd.read_csv(f, delimiter='|', names=["FirstTUI", "RelationTUI", "EndTUI"], index_col=False)
 
 
-def get_UMLS_score(StartTUI, EndTUI, startType, endType, umls_relations_df):
-    if startType != "ENTITY" or endType != "ENTITY":
-        return 1
-    else:
-        return len(umls_relations_df["RelationTUI"].loc[umls_relations_df["FirstTUI"]
-                                                        == StartTUI].loc[umls_relations_df["EndTUI"] == EndTUI])
+def tui_id(tui):
+    """
+    Row or column of a TUI in the relation counts matrix, "T047" -> 47
+    """
+    return int(tui[1:])
+
+
+def build_tui_relation_counts(umls_relations_df):
+    """
+    Dense FirstTUI x EndTUI matrix of the number of UMLS relations between two semantic types
+    """
+    first = umls_relations_df["FirstTUI"].map(tui_id).values
+    end = umls_relations_df["EndTUI"].map(tui_id).values
+    size = max(first.max(), end.max()) + 1
+    counts = np.zeros((size, size), dtype=np.int64)
+    np.add.at(counts, (first, end), 1)
+    return counts
+
+
+TUI_RELATION_COUNTS = build_tui_relation_counts(umls_relations_df)
+
+# TUIs of the CUIs linked by ner.py, read from the lookup it persisted
+semantic_lookup = SemanticGroupLookup()
+
+
+def entity_tui_sets(cuis, semantic_lookup=semantic_lookup):
+    """
+    Distinct TUI sets of a list of entities, and the id of the set of every entity
+    Entities without CUI, or with a CUI of unknown types, get the empty set
+    """
+    cui_codes, unique_cuis = pd.factorize(pd.Series(cuis, dtype=object))
+    tui_sets = {(): 0}
+    unique_set_ids = np.zeros(len(unique_cuis) + 1, dtype=np.int64)
+    for i, cui in enumerate(unique_cuis):
+        tuis = semantic_lookup(cui)[0]
+        unique_set_ids[i] = tui_sets.setdefault(tuis, len(tui_sets))
+
+    # Missing CUIs are coded -1, which points at the last slot, left to the empty set
+    return list(tui_sets), unique_set_ids[cui_codes]
+
+
+def tui_sets_scores(tui_sets, counts=TUI_RELATION_COUNTS):
+    """
+    UMLS score between every two TUI sets: the number of UMLS relations from any TUI of the first set to any TUI
+    of the second one. As before, couples involving an entity without types score 1
+    """
+    indicator = np.zeros((len(tui_sets), counts.shape[0]), dtype=np.int64)
+    for i, tuis in enumerate(tui_sets):
+        for tui in tuis:
+            if tui_id(tui) < counts.shape[0]:
+                indicator[i, tui_id(tui)] = 1
+
+    scores = indicator @ counts @ indicator.T
+    untyped = np.array([len(tuis) == 0 for tuis in tui_sets])
+    scores[untyped, :] = 1
+    scores[:, untyped] = 1
+    return scores
 
 # -----------------------------------------------------------------------------
 
 
-def build_relations_from_filename(filename):
+RELATIONS_COLUMNS = ["First", "End", "FirstWord", "SecondWord", "Sentence", "Document", "FirstType", "SecondType",
+                     "FirstCUI", "SecondCUI", "Distance", "UMLSScore"]
+
+# Relations are built again when any of their settings change
+RELATIONS_VERSION = config_hash({"max_dist": MAX_DIST, "columns": RELATIONS_COLUMNS})
+
+
+def pair_entities(sentences, start_words, end_words, max_dist=MAX_DIST):
     """
-    Pairs all possible entities in the text
-    Naively done for now - TODO: Lower the number of relations
+    Returns the row ids (first, end) of every couple of entities of the same sentence, end after first, with at most
+    max_dist words between the end of the first one and the start of the second one
+    Entities are sorted by sentence and start word, so the partners of an entity are a contiguous range of rows,
+    found with a binary search on a (sentence, start word) key, and the pairs are generated directly from the ranges
     """
-    with open(os.path.join(ARTICLES_PATH, filename, "entities.csv"), "r") as f:
-        entities_df = pd.read_csv(f).drop("Unnamed: 0", axis=1)
+    n = len(sentences)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    order = np.lexsort((start_words, sentences))
+    sentences = sentences[order]
+    start_words = start_words[order]
+    end_words = end_words[order]
+
+    # Any word id within reach of an entity stays below the stride, so keys never spill over the next sentence
+    stride = int(max(start_words.max(), end_words.max())) + max(max_dist, 0) + 1
+    keys = sentences * stride + start_words
+    limits = np.searchsorted(keys, sentences * stride + end_words + max_dist, side="right")
 
-    relations_dicts = []
+    firsts = np.arange(n)
+    counts = np.maximum(limits - (firsts + 1), 0)
+    total = int(counts.sum())
+    first_rows = np.repeat(firsts, counts)
+    # Position of each pair inside the range of its first entity
+    range_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    end_rows = first_rows + 1 + np.arange(total) - range_starts
 
-    for i in range(len(entities_df)):
-        forward_df = entities_df.iloc[i + 1:].loc[entities_df["Sentence"] == entities_df.iloc[i]["Sentence"]]
-        valid_relations = forward_df.loc[forward_df["Word"] != entities_df.iloc[i]["Word"]]
-        for j in range(len(valid_relations)):
-            if entities_df.iloc[i]["Word"] != entities_df.iloc[j]["Word"]:
-                relations_dicts.append({"First": i,
-                                        "End": i + j + 1,
-                                        "FirstWord": entities_df.iloc[i]["Word"],
-                                        "SecondWord": valid_relations.iloc[j]["Word"],
-                                        "Sentence": entities_df.iloc[i]["Sentence"],
-                                        "Document": entities_df.iloc[i]["Document"],
-                                        "FirstType": entities_df.iloc[i]["Type"],
-                                        "SecondType": valid_relations.iloc[j]["Type"],
-                                        "FirstCUI": entities_df.iloc[i]["CUI"],
-                                        "SecondCUI": valid_relations.iloc[j]["CUI"],
-                                        "Distance": valid_relations.iloc[j]["StartWord"] - entities_df.iloc[i]["EndWord"]})
+    return order[first_rows], order[end_rows]
 
-    return pd.DataFrame(relations_dicts)
+
+def build_relations_from_filename(filename, max_dist=MAX_DIST):
+    """
+    Pairs the entities of the same sentence that are at most max_dist words apart, and not the same word
+    Each relation is scored by the number of UMLS relations between the semantic types of its entities
+    """
+    entities_df = read_entities(filename, columns=["Word", "Type", "CUI", "Document", "StartWord", "EndWord",
+                                                   "Sentence"])
+
+    first, end = pair_entities(entities_df["Sentence"].values.astype(np.int64),
+                               entities_df["StartWord"].values.astype(np.int64),
+                               entities_df["EndWord"].values.astype(np.int64), max_dist)
+
+    words = entities_df["Word"].values
+    different = words[first] != words[end]
+    first = first[different]
+    end = end[different]
+
+    tui_sets, set_ids = entity_tui_sets(entities_df["CUI"].values)
+    umls_scores = tui_sets_scores(tui_sets)[set_ids[first], set_ids[end]]
+
+    return pd.DataFrame({"First": first,
+                         "End": end,
+                         "FirstWord": words[first],
+                         "SecondWord": words[end],
+                         "Sentence": entities_df["Sentence"].values[first],
+                         "Document": entities_df["Document"].values[first],
+                         "FirstType": entities_df["Type"].values[first],
+                         "SecondType": entities_df["Type"].values[end],
+                         "FirstCUI": entities_df["CUI"].values[first],
+                         "SecondCUI": entities_df["CUI"].values[end],
+                         "Distance": entities_df["StartWord"].values[end] - entities_df["EndWord"].values[first],
+                         "UMLSScore": umls_scores},
+                        columns=RELATIONS_COLUMNS)
 
 # -----------------------------------------------------------------------------
 
 
-for filename in tqdm(os.listdir(ARTICLES_PATH)):
+def relate_article(folder):
+    """
+    Builds the relations of an article
+    Skipped if its entities and the relation settings are the same as the last time, and any error is returned
+    instead of raised, so a single bad article does not stop the run
+    """
+    article_path = os.path.join(ARTICLES_PATH, folder)
+    entities_path = stored_path(folder, "entities")
+    if entities_path is None:
+        # Relations of entities that are gone
+        remove_table(folder, "relations")
+        return folder, "missing", None
+
+    try:
+        state = {"entities": file_hash(entities_path), "relations": RELATIONS_VERSION}
+        if load_state(article_path, "relations") == state and stored_path(folder, "relations") is not None:
+            return folder, "skipped", None
+
+        write_relations(folder, build_relations_from_filename(folder))
+    except Exception as e:
+        return folder, "failed", f"{type(e).__name__}: {e}"
+
+    save_state(article_path, "relations", state)
+    return folder, "built", None
+
+
+def build_corpus_relations(n_workers=None, chunksize=16):
+    """
+    Builds the relations of every article of ARTICLES_PATH, spread over n_workers processes (all cores by default)
+    Articles are sent to the workers chunksize at a time, failures are written to logs/relations_failures.txt
+    """
+    folders = sorted(os.listdir(ARTICLES_PATH))
+
+    statuses = Counter()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor, \
+            open(os.path.join(LOGS_PATH, "relations_failures.txt"), "w") as log_file:
+        for folder, status, message in tqdm(executor.map(relate_article, folders, chunksize=chunksize),
+                                            total=len(folders)):
+            statuses[status] += 1
+            if status == "failed":
+                log_file.write(f"{folder}\t{message}\n")
+
+    print(f"Built the relations of {statuses['built']} articles, {statuses['skipped']} already up to date, "
+          f"{statuses['missing']} without entities, {statuses['failed']} failed (see relations_failures.txt)")
+
+    return statuses
+
+# -----------------------------------------------------------------------------
+
 
-    relations_df = build_relations_from_filename(filename)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the relations of every article")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes, all cores by default")
+    parser.add_argument("--chunksize", type=int, default=16, help="Number of articles sent to a process at a time")
+    args = parser.parse_args()
 
-    with open(os.path.join(ARTICLES_PATH, filename, "relations.csv"), "wb") as f:
-        relations_df.to_csv(f)
+    build_corpus_relations(args.workers, args.chunksize)
@@ -0,0 +1,259 @@
+import os
+import gc
+import json
+import time
+import random
+import argparse
+import multiprocessing as mp
+
+import joblib
+import numpy as np
+from spacy.language import Language
+from scispacy.file_cache import cached_path
+from scispacy.linking import EntityLinker
+from scispacy.linking_utils import Entity
+from scispacy.candidate_generation import (CandidateGenerator, DEFAULT_PATHS,
+                                           load_approximate_nearest_neighbours_index)
+
+from constants import *
+
+SHARED_LINKER_PATH = os.path.join(DATA_PATH, "linker_shared")
+
+# -----------------------------------------------------------------------------
+# The knowledge base and the concept aliases of the scispacy linker are plain python dicts and lists: every process
+# using them ends up with its own copy, even forked ones as reference counting writes to their pages.
+# They are exported once to flat files, then memory-mapped, so all NER workers of a node share the page cache.
+# The approximate nearest neighbours index and the tfidf vectorizer are loaded once in the parent process, and
+# shared copy-on-write with the forked workers.
+
+
+class MappedStrings():
+
+    def __init__(self, path, name):
+        """
+        Read-only list of strings stored one after the other in a memory-mapped file, along with their offsets
+        """
+        self.offsets = np.load(os.path.join(path, name + "_offsets.npy"), mmap_mode="r")
+        blob_path = os.path.join(path, name + ".bin")
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    @staticmethod
+    def write(path, name, strings):
+        offsets = [0]
+        with open(os.path.join(path, name + ".bin"), "wb") as f:
+            for string in strings:
+                encoded = string.encode("utf-8")
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+        np.save(os.path.join(path, name + "_offsets.npy"), np.array(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.raw(i).decode("utf-8")
+
+
+class MappedMapping():
+
+    def __init__(self, path, name, decode):
+        """
+        Read-only dict of strings to json values, keys sorted for binary searches, both memory-mapped
+        decode(key, value) turns a stored json value back into the original python object
+        """
+        self.keys = MappedStrings(path, name + "_keys")
+        self.values = MappedStrings(path, name + "_values")
+        self.decode = decode
+
+    @staticmethod
+    def write(path, name, mapping, encode):
+        keys = sorted(mapping.keys(), key=lambda key: key.encode("utf-8"))
+        MappedStrings.write(path, name + "_keys", keys)
+        MappedStrings.write(path, name + "_values", (json.dumps(encode(mapping[key])) for key in keys))
+
+    def _find(self, key):
+        encoded = key.encode("utf-8")
+        low, high = 0, len(self.keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self.keys.raw(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.keys) and self.keys.raw(low) == encoded:
+            return low
+        return -1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self._find(key) != -1
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        return self.decode(key, json.loads(self.values[i]))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class MappedKnowledgeBase():
+
+    def __init__(self, path=SHARED_LINKER_PATH):
+        """
+        Drop-in replacement for the scispacy KnowledgeBase, backed by memory-mapped files
+        """
+        self.cui_to_entity = MappedMapping(path, "cui_to_entity", lambda cui, value: Entity(cui, *value))
+        self.alias_to_cuis = MappedMapping(path, "alias_to_cuis", lambda alias, value: set(value))
+
+# -----------------------------------------------------------------------------
+
+
+def _linker_path(linker_name, path):
+    return os.path.join(path, linker_name)
+
+
+def export_linker(linker_name="umls", path=SHARED_LINKER_PATH):
+    """
+    Writes the knowledge base and the concept aliases of a scispacy linker to memory-mappable files
+    Needs to load the full linker once
+    """
+    linker_path = _linker_path(linker_name, path)
+    os.makedirs(linker_path, exist_ok=True)
+    generator = CandidateGenerator(name=linker_name)
+
+    MappedMapping.write(linker_path, "cui_to_entity", generator.kb.cui_to_entity,
+                        lambda entity: [entity.canonical_name, list(entity.aliases), list(entity.types),
+                                        entity.definition])
+    MappedMapping.write(linker_path, "alias_to_cuis", generator.kb.alias_to_cuis, lambda cuis: sorted(cuis))
+    MappedStrings.write(linker_path, "concept_aliases", generator.ann_concept_aliases_list)
+
+    # Written last, an interrupted export is started over
+    with open(os.path.join(linker_path, "done"), "w") as f:
+        f.write(linker_name)
+
+
+def shared_candidate_generator(linker_name="umls", path=SHARED_LINKER_PATH):
+    """
+    Candidate generator using the memory-mapped knowledge base and concept aliases, exported first if needed
+    """
+    linker_path = _linker_path(linker_name, path)
+    if not os.path.exists(os.path.join(linker_path, "done")):
+        export_linker(linker_name, path)
+        gc.collect()
+
+    linker_paths = DEFAULT_PATHS[linker_name]
+    return CandidateGenerator(ann_index=load_approximate_nearest_neighbours_index(linker_paths),
+                              tfidf_vectorizer=joblib.load(cached_path(linker_paths.tfidf_vectorizer)),
+                              ann_concept_aliases_list=MappedStrings(linker_path, "concept_aliases"),
+                              kb=MappedKnowledgeBase(linker_path))
+
+
+@Language.factory("shared_scispacy_linker",
+                  default_config={"resolve_abbreviations": True, "k": 30, "threshold": 0.7,
+                                  "no_definition_threshold": 0.95, "filter_for_definitions": True,
+                                  "max_entities_per_mention": 5, "linker_name": "umls",
+                                  "shared_path": SHARED_LINKER_PATH})
+def create_shared_linker(nlp, name, resolve_abbreviations, k, threshold, no_definition_threshold,
+                         filter_for_definitions, max_entities_per_mention, linker_name, shared_path):
+    """
+    Same as the scispacy_linker pipe, with its knowledge base shared between processes
+    Add it with name="scispacy_linker" so it is found like the original one
+    """
+    return EntityLinker(nlp=nlp, name=name,
+                        candidate_generator=shared_candidate_generator(linker_name, shared_path),
+                        resolve_abbreviations=resolve_abbreviations, k=k, threshold=threshold,
+                        no_definition_threshold=no_definition_threshold,
+                        filter_for_definitions=filter_for_definitions,
+                        max_entities_per_mention=max_entities_per_mention)
+
+# -----------------------------------------------------------------------------
+# Measures startup time and memory of workers loading their own linker, against workers sharing one
+
+
+def memory_mb():
+    """
+    Resident, proportional (shared pages split between the processes using them) and unique memory, Linux only
+    """
+    fields = {}
+    with open("/proc/self/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0][:-1]] = int(parts[1]) / 1024
+    return {"rss": fields.get("Rss", 0),
+            "pss": fields.get("Pss", 0),
+            "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+
+def _worker(generator, mentions, started, queue):
+    if generator is None:
+        generator = CandidateGenerator(name="umls")
+    startup = time.perf_counter() - started
+
+    for candidates in generator(mentions, 30):
+        for candidate in candidates:
+            generator.kb.cui_to_entity[candidate.concept_id]
+
+    queue.put({"startup": startup, **memory_mb()})
+
+
+def _run_workers(context, n_workers, generator, mentions):
+    queue = context.Queue()
+    processes = [context.Process(target=_worker, args=(generator, mentions, time.perf_counter(), queue))
+                 for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return results
+
+
+def report(n_workers=4, n_mentions=1000):
+    """
+    Every worker links the same sample of aliases, and reports its startup time and memory once done
+    """
+    generator = shared_candidate_generator()
+    aliases = generator.ann_concept_aliases_list
+    random_gen = random.Random(0)
+    mentions = [aliases[random_gen.randrange(len(aliases))] for _ in range(n_mentions)]
+
+    # Workers loading their own linker are started from a clean interpreter, like spawned NER workers
+    own = _run_workers(mp.get_context("spawn"), n_workers, None, mentions)
+
+    gc.freeze()
+    shared = _run_workers(mp.get_context("fork"), n_workers, generator, mentions)
+
+    for label, results in [("Own linker per worker", own), ("Shared linker", shared)]:
+        print(f"\n{label}, {n_workers} workers")
+        for key, name, unit in [("startup", "Startup", "s"), ("rss", "Resident memory", "MB"),
+                                ("pss", "Proportional memory", "MB"), ("uss", "Unique memory", "MB")]:
+            values = [result[key] for result in results]
+            print(f"  {name}: {np.mean(values):.1f}{unit} per worker (max {np.max(values):.1f}{unit})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the UMLS linker to shared files and reports its footprint")
+    parser.add_argument("--export", action="store_true", help="Exports the linker again, even if already done")
+    parser.add_argument("--workers", type=int, default=4, help="Number of workers to measure")
+    parser.add_argument("--mentions", type=int, default=1000, help="Number of mentions linked by each worker")
+
+    args = parser.parse_args()
+    if args.export:
+        export_linker()
+    report(args.workers, args.mentions)
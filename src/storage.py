@@ -0,0 +1,150 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+from constants import *
+
+# -----------------------------------------------------------------------------
+# Typed columnar storage of the entities and relations of every article
+# Repeated strings (types, CUIs, document ids) are dictionary encoded, and read back as pandas categoricals.
+# Readers only load the columns they ask for, and fall back to the csv files written before this storage existed.
+
+_category = pa.dictionary(pa.int32(), pa.string())
+
+ENTITIES_SCHEMA = pa.schema([("Word", pa.string()),
+                             ("Type", _category),
+                             ("CUI", _category),
+                             ("Document", _category),
+                             ("StartChar", pa.int32()),
+                             ("EndChar", pa.int32()),
+                             ("StartWord", pa.int32()),
+                             ("EndWord", pa.int32()),
+                             ("Sentence", pa.int32())])
+
+RELATIONS_SCHEMA = pa.schema([("First", pa.int32()),
+                              ("End", pa.int32()),
+                              ("FirstWord", pa.string()),
+                              ("SecondWord", pa.string()),
+                              ("Sentence", pa.int32()),
+                              ("Document", _category),
+                              ("FirstType", _category),
+                              ("SecondType", _category),
+                              ("FirstCUI", _category),
+                              ("SecondCUI", _category),
+                              ("Distance", pa.int32()),
+                              ("UMLSScore", pa.int32())])
+
+TABLES = {"entities": ENTITIES_SCHEMA,
+          "relations": RELATIONS_SCHEMA}
+
+# -----------------------------------------------------------------------------
+
+
+def table_path(folder, kind):
+    return os.path.join(ARTICLES_PATH, folder, kind + ".parquet")
+
+
+def _csv_path(folder, kind):
+    return os.path.join(ARTICLES_PATH, folder, kind + ".csv")
+
+
+def stored_path(folder, kind):
+    """
+    File holding a table of an article, the parquet file if there is one, then the former csv file, None otherwise
+    """
+    for path in [table_path(folder, kind), _csv_path(folder, kind)]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def has_table(folder, kind):
+    return stored_path(folder, kind) is not None
+
+
+def to_arrow(df, schema):
+    """
+    Arrow table of a dataframe following one of the schemas above
+    """
+    arrays = []
+    for field in schema:
+        column = df[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(column.astype("string")).dictionary_encode())
+        elif pa.types.is_string(field.type):
+            arrays.append(pa.array(column.astype("string")))
+        else:
+            arrays.append(pa.array(column.values.astype(field.type.to_pandas_dtype())))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_table(folder, kind, df):
+    """
+    Writes a table of an article, replacing the former csv file if any
+    Written to a temporary file first, so readers never see a half written table
+    """
+    path = table_path(folder, kind)
+    pq.write_table(to_arrow(df, TABLES[kind]), path + ".tmp")
+    os.replace(path + ".tmp", path)
+    if os.path.exists(_csv_path(folder, kind)):
+        os.remove(_csv_path(folder, kind))
+
+
+def remove_table(folder, kind):
+    for path in [table_path(folder, kind), _csv_path(folder, kind)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def read_table(folder, kind, columns=None):
+    """
+    Reads a table of an article, only the given columns if any
+    Raises FileNotFoundError if the article has no such table
+    """
+    path = stored_path(folder, kind)
+    if path is None:
+        raise FileNotFoundError(table_path(folder, kind))
+    if path.endswith(".parquet"):
+        return pq.read_table(path, columns=columns).to_pandas()
+
+    df = pd.read_csv(path, usecols=columns)
+    return df.drop("Unnamed: 0", axis=1, errors="ignore")
+
+
+def write_entities(folder, entities_df):
+    write_table(folder, "entities", entities_df)
+
+
+def read_entities(folder, columns=None):
+    return read_table(folder, "entities", columns)
+
+
+def write_relations(folder, relations_df):
+    write_table(folder, "relations", relations_df)
+
+
+def read_relations(folder, columns=None):
+    return read_table(folder, "relations", columns)
+
+# -----------------------------------------------------------------------------
+
+
+def corpus_dataset(kind, folders=None):
+    """
+    Single pyarrow dataset over the tables of every article (articles still stored as csv are left out)
+    """
+    if folders is None:
+        folders = sorted(os.listdir(ARTICLES_PATH))
+    paths = [table_path(folder, kind) for folder in folders]
+    return ds.dataset([path for path in paths if os.path.exists(path)], schema=TABLES[kind], format="parquet")
+
+
+def read_corpus(kind, columns=None, filter=None, folders=None):
+    """
+    Loads a table for the whole corpus at once, only the given columns and the rows matching filter
+    (a pyarrow.dataset expression, like ds.field("Type") == "DISO"). Files are read by several threads
+    """
+    return corpus_dataset(kind, folders).to_table(columns=columns, filter=filter).to_pandas()
@@ -0,0 +1,73 @@
+import os
+import json
+from collections import Counter
+
+from constants import *
+
+# CUI -> TUIs of every concept linked so far, kept across runs
+CUI_TYPES_PATH = os.path.join(DATA_PATH, "cui_types.json")
+
+# -----------------------------------------------------------------------------
+
+
+def semantic_group(tuis):
+    """
+    Semantic group of a concept from all of its TUIs: the group most of them belong to, ties going to the
+    group of the first TUI. None if no TUI is part of a known group
+    """
+    groups = [TUI_MAP[tui] for tui in tuis if tui in TUI_MAP]
+    if len(groups) == 0:
+        return None
+    counts = Counter(groups)
+    best = max(counts.values())
+    for group in groups:
+        if counts[group] == best:
+            return group
+
+
+class SemanticGroupLookup():
+
+    def __init__(self, kb=None, path=CUI_TYPES_PATH):
+        """
+        Memoized CUI -> (TUIs, semantic group) lookup
+        TUIs are read from the types of the knowledge base entities the first time a CUI is seen, and persisted
+        to path so later runs (or stages without the knowledge base loaded) do not need to look them up again
+        """
+        self.kb = kb
+        self.path = path
+        self.cui_tuis = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.cui_tuis = json.load(f)
+        self._memo = {}
+        self._new = 0
+
+    def __call__(self, cui):
+        """
+        Returns the TUIs and the semantic group of a CUI, ((), None) if it is unknown
+        """
+        if cui in self._memo:
+            return self._memo[cui]
+
+        tuis = self.cui_tuis.get(cui)
+        if tuis is None:
+            if self.kb is None or cui not in self.kb.cui_to_entity:
+                return (), None
+            tuis = list(self.kb.cui_to_entity[cui].types)
+            self.cui_tuis[cui] = tuis
+            self._new += 1
+
+        result = (tuple(tuis), semantic_group(tuis))
+        self._memo[cui] = result
+        return result
+
+    def save(self):
+        """
+        Persists the CUIs seen for the first time since the last save
+        """
+        if self._new == 0:
+            return
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.cui_tuis, f)
+        os.replace(self.path + ".tmp", self.path)
+        self._new = 0